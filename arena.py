@@ -1,5 +1,12 @@
+import math
+import multiprocessing as mp
+
+import numpy as np
+import torch
 from tqdm import tqdm
 
+from mcts import make_mcts
+
 class Arena():
     """
     An Arena class where any 2 agents can be pit against each other.
@@ -41,7 +48,8 @@ class Arena():
             if hasattr(player, "startGame"):
                 player.startGame()
 
-        while self.game.get_game_outcome(board, curPlayer) == 0:
+        outcome = self.game.get_game_outcome(board, curPlayer)
+        while outcome == 0:
             it += 1
             if verbose:
                 assert self.display
@@ -61,7 +69,7 @@ class Arena():
             if hasattr(opponent, "notify"):
                 opponent.notify(board, action)
 
-            board, curPlayer = self.game.get_next_state(board, action, curPlayer)
+            board, curPlayer, outcome = self.game.step(board, action, curPlayer)
 
         for player in players[0], players[2]:
             if hasattr(player, "endGame"):
@@ -72,18 +80,21 @@ class Arena():
             print("Game over: Turn ", str(it), "Result ", str(self.game.get_game_outcome(board, 1)))
             self.display(board)
 
-        return curPlayer * self.game.get_game_outcome(board, curPlayer)
+        return curPlayer * outcome
 
-    def play_games(self, num, verbose=False):
+    def play_games(self, num, verbose=False, num_workers=1):
         """
         Plays num games in which player1 starts num/2 games and player2 starts
-        num/2 games.
+        num/2 games. With num_workers > 1 the games are spread over that many
+        processes, which requires picklable players (see MCTSPlayer).
 
         Returns:
             oneWon: games won by player1
             twoWon: games won by player2
             draws:  games won by nobody
         """
+        if num_workers > 1:
+            return self.play_games_parallel(num, num_workers)
 
         num = int(num / 2)
         oneWon = 0
@@ -110,3 +121,126 @@ class Arena():
                 draws += 1
 
         return oneWon, twoWon, draws
+
+    def play_game_swapped(self, swapped, verbose=False):
+        """
+        Plays one game, started by player2 if swapped and by player1 otherwise.
+
+        Returns:
+            1 if player1 won, -1 if player2 won, 0 for a draw
+        """
+        if swapped:
+            result = -Arena(self.player2, self.player1, self.game, self.display).play_game(verbose=verbose)
+        else:
+            result = self.play_game(verbose=verbose)
+        return int(result) if abs(result) == 1 else 0
+
+    def make_pool(self, num_workers, threads=1):
+        """
+        A pool of num_workers processes that each hold their own copy of both
+        players (and so their own search trees) and use threads torch threads.
+        Its workers play games with play_arena_game.
+        """
+        return mp.get_context('spawn').Pool(num_workers, initializer=init_arena_worker,
+                                             initargs=(self.player1, self.player2, self.game, threads))
+
+    def play_games_parallel(self, num, num_workers, threads=1):
+        """
+        play_games over a pool of num_workers processes, see make_pool.
+        """
+        num = int(num / 2)
+        swaps = [False] * num + [True] * num
+        with self.make_pool(num_workers, threads) as pool:
+            results = list(tqdm(pool.imap_unordered(play_arena_game, swaps), total=len(swaps),
+                                desc="Arena.playGames (parallel)"))
+
+        return results.count(1), results.count(-1), results.count(0)
+
+    def play_games_sprt(self, max_games, p0, p1, alpha=0.05, beta=0.05, num_workers=1, verbose=False):
+        """
+        Plays games until a sequential probability ratio test decides between
+        H0: player2 wins a decisive game with probability p0, and
+        H1: player2 wins a decisive game with probability p1 (> p0),
+        with error rates alpha (accepting H1 although H0 holds) and beta
+        (accepting H0 although H1 holds), or until max_games were played.
+        Draws carry no information and are skipped by the test.
+
+        Games are played in pairs, one started by each player, or in batches
+        of num_workers games (rounded up to an even number) when parallel.
+
+        Returns:
+            oneWon: games won by player1
+            twoWon: games won by player2
+            draws:  games won by nobody
+            accepted: True if H1 was accepted, False if H0 was, None if
+                      max_games ran out first
+        """
+        lower, upper = math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+        llr_win, llr_loss = math.log(p1 / p0), math.log((1 - p1) / (1 - p0))
+        batch_size = max(2, num_workers + num_workers % 2)
+        pool = self.make_pool(num_workers) if num_workers > 1 else None
+
+        results = []
+        accepted = None
+        llr = 0
+        try:
+            with tqdm(total=max_games, desc="Arena.playGames (SPRT)") as t:
+                while len(results) < max_games:
+                    swaps = [i % 2 == 1 for i in range(min(batch_size, max_games - len(results)))]
+                    if pool is not None:
+                        results += pool.map(play_arena_game, swaps)
+                    else:
+                        results += [self.play_game_swapped(swapped, verbose=verbose) for swapped in swaps]
+                    t.update(len(swaps))
+
+                    llr = results.count(-1) * llr_win + results.count(1) * llr_loss
+                    t.set_postfix(LLR=f'{llr:.2f}')
+                    if llr >= upper:
+                        accepted = True
+                        break
+                    if llr <= lower:
+                        accepted = False
+                        break
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        decision = {True: 'H1 accepted', False: 'H0 accepted', None: 'undecided'}[accepted]
+        print(f'SPRT: {decision} after {len(results)} games, LLR = {llr:.2f} (bounds {lower:.2f}, {upper:.2f})')
+        return results.count(1), results.count(-1), results.count(0), accepted
+
+
+class MCTSPlayer():
+    """
+    A player that picks the most visited action of its own MCTS. Its search
+    tree is not pickled, so it can be sent to other processes, where it starts
+    with an empty tree.
+    """
+
+    def __init__(self, game, nnet, args):
+        self.game = game
+        self.nnet = nnet
+        self.args = args
+        self.mcts = make_mcts(game, nnet, args)
+
+    def __call__(self, board):
+        return np.argmax(self.mcts.get_action_prob(board, temp=0))
+
+    def __getstate__(self):
+        return {'game': self.game, 'nnet': self.nnet, 'args': self.args}
+
+    def __setstate__(self, state):
+        self.__init__(state['game'], state['nnet'], state['args'])
+
+
+_arena = None  # Arena of an arena worker process
+
+
+def init_arena_worker(player1, player2, game, threads):
+    global _arena
+    torch.set_num_threads(threads)
+    _arena = Arena(player1, player2, game)
+
+
+def play_arena_game(swapped):
+    return _arena.play_game_swapped(swapped)
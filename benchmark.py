@@ -0,0 +1,231 @@
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from coach import Coach
+from connect4.connect4 import Connect4
+from connect4.connect4_bitboard import Connect4Bitboard
+from connect4.connect4_network import NNetWrapper as Connect4Net
+from main import args as train_args
+from mcts import make_mcts
+from tictactoe.tictactoe import TicTacToe
+from tictactoe.tictactoe_network import NNetWrapper as TicTacToeNet
+
+args = {
+    'output': './benchmarks/latest.json',      # Where the results are written.
+    'baseline': './benchmarks/baseline.json',  # Results compared against, if the file exists.
+    'save_baseline': False,        # Write the results to the baseline file too.
+    'regression_threshold': 0.10,  # Relative slowdown against the baseline reported as a regression.
+    'seconds': 1.0,                # Time spent measuring each rate.
+    'num_positions': 256,          # Random positions the game ops and predictions run on.
+    'num_mcts_sims': 200,          # Simulations per search of the MCTS benchmarks.
+    'batch_sizes': (1, 8, 64),     # Batch sizes of NNetWrapper.predict_batch.
+    'train_examples': 4096,        # Random examples of the training benchmark, trained on for one epoch.
+    'episode_sims': 25,            # Simulations per move of the execute_episode benchmark,
+    'num_episodes': 3,             #   averaged over this many episodes.
+    'mcts_tree': 'array',
+}
+
+GAMES = [
+    ('tictactoe', TicTacToe, TicTacToeNet),
+    ('connect4', Connect4, Connect4Net),
+    ('connect4_bitboard', Connect4Bitboard, Connect4Net),
+]
+
+
+class UniformNet():
+    """
+    Stand-in network with a uniform policy and a value of 0, so the MCTS
+    benchmark measures the search alone.
+    """
+
+    def __init__(self, game):
+        self.pi = np.full(game.get_action_size(), 1 / game.get_action_size(), dtype=np.float32)
+
+    def predict(self, board):
+        return self.pi, np.zeros(1, dtype=np.float32)
+
+    def predict_batch(self, boards):
+        return np.tile(self.pi, (len(boards), 1)), np.zeros(len(boards), dtype=np.float32)
+
+
+def random_states(game, num_states):
+    """
+    Returns num_states canonical, non-terminal states of random games.
+    """
+    rng = np.random.default_rng(0)
+    states = []
+    while len(states) < num_states:
+        state, player = game.get_initial_state(), 1
+        while len(states) < num_states:
+            canonical = game.get_cannonical_state(state, player)
+            states.append(canonical)
+            state, player, r = game.step(state, rng.choice(np.flatnonzero(game.get_valid_actions(canonical))), player)
+            if r != 0:
+                break
+    return states
+
+
+def rate(fn, items, seconds):
+    """
+    Calls fn on items, cycling through them, for about seconds.
+
+    Returns:
+        calls per second
+    """
+    calls, start = 0, time.time()
+    while time.time() - start < seconds:
+        for item in items:
+            fn(item)
+        calls += len(items)
+    return calls / (time.time() - start)
+
+
+def bench_game_ops(game, states, seconds):
+    moves = [(s, int(np.flatnonzero(game.get_valid_actions(s))[0])) for s in states]
+    return {
+        'get_next_state': rate(lambda m: game.get_next_state(m[0], m[1], 1), moves, seconds),
+        'get_game_outcome': rate(lambda s: game.get_game_outcome(s, 1), states, seconds),
+        'get_valid_actions': rate(game.get_valid_actions, states, seconds),
+        'state_to_string': rate(game.state_to_string, states, seconds),
+    }
+
+
+def bench_mcts(game, nnet, num_sims, seconds):
+    """
+    Returns:
+        simulations per second of searches from the initial state with fresh trees
+    """
+    mcts_args = {'num_mcts_sims': num_sims, 'cpuct': 1, 'mcts_tree': args['mcts_tree']}
+    # compile the numba kernels and build the inference model outside the measurement
+    make_mcts(game, nnet, mcts_args).get_action_prob(game.get_initial_state(), temp=1)
+    sims, start = 0, time.time()
+    while time.time() - start < seconds:
+        make_mcts(game, nnet, mcts_args).get_action_prob(game.get_initial_state(), temp=1)
+        sims += num_sims
+    return sims / (time.time() - start)
+
+
+def bench_predict(nnet, boards, batch_sizes, seconds):
+    results = dict()
+    for batch_size in batch_sizes:
+        batches = [boards[i:i + batch_size] for i in range(0, len(boards) - batch_size + 1, batch_size)]
+        nnet.predict_batch(batches[0])  # build the inference model outside the measurement
+        calls = rate(nnet.predict_batch, batches, seconds)
+        results[f'predict_batch_{batch_size}_ms'] = 1000 / calls
+        results[f'predict_batch_{batch_size}_positions_per_s'] = calls * batch_size
+    return results
+
+
+def bench_train(game, nnet, num_examples):
+    """
+    Returns:
+        training samples per second over one epoch of random examples
+    """
+    net_args = sys.modules[type(nnet).__module__].args
+    rng = np.random.default_rng(0)
+    rows, cols = game.get_board_size()
+    examples = [(rng.integers(-1, 2, (rows, cols)), rng.dirichlet(np.ones(game.get_action_size())), rng.choice([-1., 1.]))
+                for _ in range(num_examples)]
+    epochs, net_args['epochs'] = net_args['epochs'], 1
+    try:
+        nnet.train(examples[:net_args['batch_size']])  # warm torch up outside the measurement
+        start = time.time()
+        nnet.train(examples)
+        elapsed = time.time() - start
+    finally:
+        net_args['epochs'] = epochs
+    return num_examples // net_args['batch_size'] * net_args['batch_size'] / elapsed
+
+
+def bench_episode(game, nnet, num_sims, num_episodes):
+    """
+    Returns:
+        mean wall time in seconds of a self-play episode
+    """
+    coach_args = dict(train_args, num_mcts_sims=num_sims, mcts_tree=args['mcts_tree'], eval_cache_size=0)
+    coach = Coach(game, nnet, coach_args)
+    start = time.time()
+    for _ in range(num_episodes):
+        coach.mcts = make_mcts(game, nnet, coach_args)
+        coach.execute_episode()
+    return (time.time() - start) / num_episodes
+
+
+def run():
+    """
+    Returns:
+        {metric: value}, where metrics ending in _ms or _s are times (lower is better)
+        and all others are rates (higher is better)
+    """
+    np.random.seed(0)
+    results = dict()
+    for name, game, nnet_class in GAMES:
+        print(f'Benchmarking {name}...')
+        states = random_states(game, args['num_positions'])
+        boards = np.array([np.asarray(s) for s in states])
+        for op, value in bench_game_ops(game, states, args['seconds']).items():
+            results[f'{name}.{op}_per_s'] = value
+
+        results[f'{name}.mcts_stub_sims_per_s'] = bench_mcts(game, UniformNet(game), args['num_mcts_sims'], args['seconds'])
+        nnet = nnet_class(game)
+        results[f'{name}.mcts_net_sims_per_s'] = bench_mcts(game, nnet, args['num_mcts_sims'], args['seconds'])
+        for metric, value in bench_predict(nnet, boards, args['batch_sizes'], args['seconds']).items():
+            results[f'{name}.{metric}'] = value
+        results[f'{name}.train_samples_per_s'] = bench_train(game, nnet, args['train_examples'])
+        results[f'{name}.episode_s'] = bench_episode(game, nnet, args['episode_sims'], args['num_episodes'])
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns:
+        the lines of a comparison table and the names of the metrics that got
+        worse than the baseline by more than threshold
+    """
+    lines, regressions = [], []
+    for metric in sorted(results):
+        value = results[metric]
+        if metric not in baseline:
+            lines.append(f'{metric:50s} {value:14.3f}')
+            continue
+        lower_is_better = metric.endswith('_ms') or metric.endswith('_s') and not metric.endswith('_per_s')
+        change = value / baseline[metric] - 1 if baseline[metric] else 0.
+        slowdown = change if lower_is_better else -change
+        flag = ''
+        if slowdown > threshold:
+            regressions.append(metric)
+            flag = '  REGRESSION'
+        lines.append(f'{metric:50s} {value:14.3f} {baseline[metric]:14.3f} {change:+8.1%}{flag}')
+    return lines, regressions
+
+
+def main():
+    results = run()
+    os.makedirs(os.path.dirname(args['output']) or '.', exist_ok=True)
+    with open(args['output'], 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    print(f'Results written to {args["output"]}')
+
+    baseline = dict()
+    if os.path.isfile(args['baseline']):
+        with open(args['baseline']) as f:
+            baseline = json.load(f)
+    lines, regressions = compare(results, baseline, args['regression_threshold'])
+    print(f'{"metric":50s} {"value":>14s} {"baseline":>14s} {"change":>8s}')
+    print('\n'.join(lines))
+
+    if args['save_baseline']:
+        with open(args['baseline'], 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print(f'Baseline written to {args["baseline"]}')
+    if regressions:
+        print(f'{len(regressions)} regressions over {args["regression_threshold"]:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
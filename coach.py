@@ -1,14 +1,22 @@
+import multiprocessing as mp
 import os
+import queue
+import random
 import sys
 from collections import deque
-from pickle import Pickler, Unpickler
-from random import shuffle
+from pickle import Unpickler
 
 import numpy as np
+import torch
 from tqdm import tqdm
 
-from arena import Arena
-from mcts import MCTS
+from arena import Arena, MCTSPlayer
+from eval_cache import CachedNNet, EvalCache, format_cache_stats
+from inference_server import InferenceServer
+from instrumentation import IterationRecorder, profile
+from mcts import SearchStats, make_mcts
+from replay_buffer import ReplayBuffer, ShardedExamples, ShardStore, to_arrays
+from training import SymmetricExamples
 
 
 
@@ -21,11 +29,23 @@ class Coach():
     def __init__(self, game, nnet, args):
         self.game = game
         self.nnet = nnet
-        self.pnet = self.nnet.__class__(self.game)  # the competitor network
+        self.pnet = None  # the competitor network, created by learn()
         self.args = args
-        self.mcts = MCTS(self.game, self.nnet, self.args)
-        self.train_examples_history = []  # history of examples from args['num_iters_for_train_examples_history'] latest iterations
+        self.mcts = make_mcts(self.game, self.nnet, self.args)
+        self.replay_buffer = self.make_replay_buffer()  # examples from args['num_iters_for_train_examples_history'] latest iterations
+        self.shard_store = ShardStore(os.path.join(self.args['checkpoint'], 'examples'))
+        self.shards = deque()  # manifest entries of the replay buffer's iterations, oldest first
+        self.search_stats = SearchStats()  # work of the searches of the current iteration
         self.skip_first_self_play = False  # can be overriden in loadTrainExamples()
+        self.eval_cache = None  # network evaluations shared by the self-play episodes of an iteration
+        if self.args.get('eval_cache_size', 0) > 0:
+            self.eval_cache = EvalCache(self.game, self.args['eval_cache_size'])
+
+    def make_replay_buffer(self):
+        # room for one iteration more than the history, which is evicted once the new one is in
+        capacity = self.args['max_len_of_queue'] * (self.args['num_iters_for_train_examples_history'] + 1)
+        return ReplayBuffer(self.game.get_board_size(), self.game.get_action_size(), capacity,
+                            pi_dtype=self.args.get('replay_pi_dtype', 'float32'))
 
     def execute_episode(self):
         """
@@ -54,18 +74,86 @@ class Coach():
             temp = int(episodeStep < self.args['temp_threshold'])
 
             pi = self.mcts.get_action_prob(canonicalBoard, temp=temp)
-            sym = self.game.get_symmetries(canonicalBoard, pi)
+            if self.args.get('augment_symmetries', False):
+                sym = [(np.asarray(canonicalBoard), pi)]  # the symmetries are applied when training samples it
+            else:
+                sym = self.game.get_symmetries(canonicalBoard, pi)
             for b, p in sym:
                 trainExamples.append([b, self.curPlayer, p, None])
 
             action = np.random.choice(len(pi), p=pi)
-            board, self.curPlayer = self.game.get_next_state(board, action, self.curPlayer)
-
-            r = self.game.get_game_outcome(board, self.curPlayer)
+            board, self.curPlayer, r = self.game.step(board, action, self.curPlayer)
 
             if r != 0:
+                self.search_stats.add(self.mcts.stats)
                 return [(x[0], x[2], r * ((-1) ** (x[1] != self.curPlayer))) for x in trainExamples]
 
+    def execute_episodes_parallel(self, iteration):
+        """
+        Plays the iteration's num_eps episodes over args['num_workers']
+        processes, each holding its own copy of the current weights and its
+        own MCTS. Episode j is always played by worker j % num_workers, seeded
+        from args['seed'], the iteration and the worker id, and the examples
+        are merged in episode order, so the result does not depend on which
+        worker finishes first.
+
+        With args['inference_server'] the workers hold no network: they send
+        their positions to one InferenceServer process that batches them.
+
+        Returns:
+            trainExamples: the examples of all episodes, in episode order
+        """
+        num_eps = self.args['num_eps']
+        num_workers = min(self.args['num_workers'], num_eps)
+        ctx = mp.get_context('spawn')
+        results = ctx.Queue()
+        state_dict = {k: v.cpu() for k, v in self.nnet.nnet.state_dict().items()}
+        seeds = np.random.SeedSequence([self.args.get('seed', 0), iteration]).generate_state(num_workers)
+
+        server = None
+        if self.args.get('inference_server', False):
+            server = InferenceServer(self.game, self.nnet.__class__, state_dict, num_workers,
+                                     max_batch_size=self.args.get('inference_max_batch_size', 64),
+                                     max_wait_us=self.args.get('inference_max_wait_us', 500), ctx=ctx).start()
+            state_dict = None
+
+        workers = []
+        for worker_id in range(num_workers):
+            episode_ids = list(range(worker_id, num_eps, num_workers))
+            client = server.clients[worker_id] if server is not None else None
+            p = ctx.Process(target=self_play_worker, daemon=True,
+                            args=(int(seeds[worker_id]), episode_ids, self.game, self.nnet.__class__, state_dict,
+                                  self.args, results, client))
+            p.start()
+            workers.append(p)
+
+        episodes = dict()
+        cache_stats = None
+        with tqdm(total=num_eps, desc="Self Play") as t:
+            while len(episodes) < num_eps:
+                try:
+                    episode_id, examples, search_stats, stats = results.get(timeout=1)
+                except queue.Empty:
+                    if any(p.exitcode not in (None, 0) for p in workers):
+                        raise RuntimeError('A self-play worker exited before finishing its episodes')
+                    if server is not None and server.process.exitcode is not None:
+                        raise RuntimeError(f'The inference server exited with code {server.process.exitcode} '
+                                           'during self-play')
+                    continue
+                episodes[episode_id] = examples
+                self.search_stats.add(search_stats)
+                if stats is not None:
+                    cache_stats = {k: v + (cache_stats or {}).get(k, 0) for k, v in stats.items()}
+                t.update()
+
+        for p in workers:
+            p.join()
+        if server is not None:
+            print(f'Inference server:\n{server.stop()}')
+        if cache_stats is not None:
+            print(format_cache_stats(cache_stats))
+        return [x for episode_id in sorted(episodes) for x in episodes[episode_id]]
+
     def learn(self):
         """
         Performs numIters iterations with numEps episodes of self-play in each
@@ -73,77 +161,153 @@ class Coach():
         examples in trainExamples (which has a maximum length of maxlenofQueue).
         It then pits the new neural network against the old one and accepts it
         only if it wins >= updateThreshold fraction of games.
+
+        With args['metrics_file'], every iteration appends a record of its
+        phase times, search work and replay window size (see IterationRecorder),
+        and with args['profile_self_play'] its self-play runs under cProfile.
         """
+        recorder = IterationRecorder(self.args.get('metrics_file'))
 
         for i in range(1, self.args['num_iters'] + 1):
             # bookkeeping
             # log.info(f'Starting Iter #{i} ...')
             print(f'Starting Iter #{i} ...')
+            recorder.start(i)
+            self.search_stats = SearchStats()
             # examples of the iteration
             if not self.skip_first_self_play or i > 1:
                 iterationTrainExamples = deque([], maxlen=self.args['max_len_of_queue'])
 
-                for _ in tqdm(range(self.args['num_eps']), desc="Self Play"):
-                    self.mcts = MCTS(self.game, self.nnet, self.args)  # reset search tree
-                    iterationTrainExamples += self.execute_episode()
+                profile_file = None
+                if self.args.get('profile_self_play', False):
+                    profile_file = os.path.join(self.args['checkpoint'], f'self_play_{i}.prof')
+                with recorder.phase('self_play'), profile(profile_file):
+                    if self.args.get('num_workers', 1) > 1:
+                        iterationTrainExamples += self.execute_episodes_parallel(i)
+                    else:
+                        nnet = self.nnet if self.eval_cache is None else CachedNNet(self.nnet, self.eval_cache)
+                        for _ in tqdm(range(self.args['num_eps']), desc="Self Play"):
+                            self.mcts = make_mcts(self.game, nnet, self.args)  # reset search tree
+                            iterationTrainExamples += self.execute_episode()
+                        if self.eval_cache is not None:
+                            print(format_cache_stats(self.eval_cache.stats()))
+                            self.eval_cache.reset_stats()
 
                 # save the iteration examples to the history 
-                self.train_examples_history.append(iterationTrainExamples)
+                with recorder.phase('save_examples'):
+                    examples = to_arrays(iterationTrainExamples, self.game.get_board_size(),
+                                         self.game.get_action_size(), self.args.get('replay_pi_dtype', 'float32'))
+                    if not self.args.get('memmap_examples', False):
+                        self.replay_buffer.add_iteration(examples)
+                    self.shards.append(self.shard_store.write(i - 1, *examples, shards=self.shards))
+            recorder.search(self.search_stats)
 
-            if len(self.train_examples_history) > self.args['num_iters_for_train_examples_history']:
+            if len(self.shards) > self.args['num_iters_for_train_examples_history']:
                 # log.warning(
-                #     f"Removing the oldest entry in trainExamples. len(trainExamplesHistory) = {len(self.train_examples_history)}")
-                print(f"Removing the oldest entry in trainExamples. len(trainExamplesHistory) = {len(self.train_examples_history)}")
-                self.train_examples_history.pop(0)
-            # backup history to a file
+                #     f"Removing the oldest entry in trainExamples. len(trainExamplesHistory) = {len(self.shards)}")
+                print(f"Removing the oldest entry in trainExamples. len(trainExamplesHistory) = {len(self.shards)}")
+                if not self.args.get('memmap_examples', False):
+                    self.replay_buffer.pop_oldest()
+                self.shards.popleft()
+            # backup history: the manifest of the shards in the window
             # NB! the examples were collected using the model from the previous iteration, so (i-1)  
-            self.save_train_examples(i - 1)
-
-            # shuffle examples before training
-            trainExamples = []
-            for e in self.train_examples_history:
-                trainExamples.extend(e)
-            shuffle(trainExamples)
+            with recorder.phase('save_examples'):
+                self.save_train_examples(i - 1)
 
             # training new network, keeping a copy of the old one
-            self.nnet.save_checkpoint(folder=self.args['checkpoint'], filename='temp.pth.tar')
-            self.pnet.load_checkpoint(folder=self.args['checkpoint'], filename='temp.pth.tar')
-            pmcts = MCTS(self.game, self.pnet, self.args)
+            with recorder.phase('checkpoint_io'):
+                if self.pnet is None:
+                    self.pnet = self.nnet.__class__(self.game)
+                self.nnet.save_checkpoint(folder=self.args['checkpoint'], filename='temp.pth.tar')
+                self.pnet.load_checkpoint(folder=self.args['checkpoint'], filename='temp.pth.tar')
 
-            self.nnet.train(trainExamples)
-            nmcts = MCTS(self.game, self.nnet, self.args)
+            # training samples random minibatches, so the examples need no shuffling
+            if self.args.get('memmap_examples', False):
+                examples = ShardedExamples(self.shard_store, self.shards)
+            else:
+                examples = self.replay_buffer
+            recorder.update(replay_examples=len(examples), replay_iterations=len(self.shards),
+                            replay_bytes=self.replay_buffer.nbytes,
+                            replay_disk_bytes=self.shard_store.nbytes(self.shards))
+            if self.args.get('augment_symmetries', False):
+                examples = SymmetricExamples(examples, self.game)
+            with recorder.phase('train'):
+                self.nnet.train(examples)
 
             # log.info('PITTING AGAINST PREVIOUS VERSION')
             print('PITTING AGAINST PREVIOUS VERSION')
-            arena = Arena(lambda x: np.argmax(pmcts.get_action_prob(x, temp=0)),
-                          lambda x: np.argmax(nmcts.get_action_prob(x, temp=0)), self.game)
-            pwins, nwins, draws = arena.play_games(self.args['arena_compare'])
+            with recorder.phase('arena'):
+                arena = Arena(MCTSPlayer(self.game, self.pnet, self.args),
+                              MCTSPlayer(self.game, self.nnet, self.args), self.game)
+                accepted = None
+                if self.args.get('arena_sprt', False):
+                    pwins, nwins, draws, accepted = arena.play_games_sprt(
+                        self.args['arena_compare'], self.args['sprt_p0'], self.args['sprt_p1'],
+                        self.args['sprt_alpha'], self.args['sprt_beta'],
+                        num_workers=self.args.get('arena_workers', 1))
+                else:
+                    pwins, nwins, draws = arena.play_games(self.args['arena_compare'],
+                                                           num_workers=self.args.get('arena_workers', 1))
 
             # log.info('NEW/PREV WINS : %d / %d ; DRAWS : %d' % (nwins, pwins, draws))
             print('NEW/PREV WINS : %d / %d ; DRAWS : %d' % (nwins, pwins, draws))
-            if pwins + nwins == 0 or float(nwins) / (pwins + nwins) < self.args['update_threshold']:
+            if accepted is None:
+                # no SPRT decision, fall back to the win rate threshold
+                accepted = pwins + nwins > 0 and float(nwins) / (pwins + nwins) >= self.args['update_threshold']
+            if not accepted:
                 # log.info('REJECTING NEW MODEL')
                 print('REJECTING NEW MODEL')
-                self.nnet.load_checkpoint(folder=self.args['checkpoint'], filename='temp.pth.tar')
+                with recorder.phase('checkpoint_io'):
+                    self.nnet.load_checkpoint(folder=self.args['checkpoint'], filename='temp.pth.tar')
             else:
                 # log.info('ACCEPTING NEW MODEL')
                 print('ACCEPTING NEW MODEL')
-                self.nnet.save_checkpoint(folder=self.args['checkpoint'], filename=self.get_checkpoint_file(i))
-                self.nnet.save_checkpoint(folder=self.args['checkpoint'], filename='best.pth.tar')
+                if self.eval_cache is not None:
+                    self.eval_cache.version += 1
+                with recorder.phase('checkpoint_io'):
+                    self.nnet.save_checkpoint(folder=self.args['checkpoint'], filename=self.get_checkpoint_file(i))
+                    self.nnet.save_checkpoint(folder=self.args['checkpoint'], filename='best.pth.tar')
+            recorder.finish()
 
     def get_checkpoint_file(self, iteration):
         return 'checkpoint_' + str(iteration) + '.pth.tar'
 
     def save_train_examples(self, iteration):
-        folder = self.args['checkpoint']
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        filename = os.path.join(folder, self.get_checkpoint_file(iteration) + ".examples")
-        with open(filename, "wb+") as f:
-            Pickler(f).dump(self.train_examples_history)
-        f.closed
+        """
+        Points the manifest at the shards of the current window and deletes
+        the shards that fell out of it. Every shard was written once, right
+        after its iteration's self-play.
+        """
+        self.shard_store.save_manifest(self.shards)
+        self.shard_store.prune(self.shards)
 
     def load_train_examples(self):
+        """
+        Rebuilds the window from the shard manifest of args['load_folder_file'],
+        or from the pickled .examples file of the model saved before shards.
+        With args['memmap_examples'] the shards are left on disk, where
+        training maps them.
+        """
+        store = ShardStore(os.path.join(self.args['load_folder_file'][0], 'examples'))
+        shards = store.load_manifest()
+        if shards is not None:
+            print("Manifest of train_examples found. Loading it...")
+            self.replay_buffer = self.make_replay_buffer()
+            if not self.args.get('memmap_examples', False):
+                for entry in shards:
+                    self.replay_buffer.add_iteration(store.read(entry))
+            self.shards = deque(shards)
+            if os.path.abspath(store.folder) != os.path.abspath(self.shard_store.folder):
+                # copy the window to the checkpoint folder, where its shards are managed
+                self.shards = deque()
+                for entry in shards:
+                    self.shards.append(self.shard_store.write(entry['iteration'], *store.read(entry, mmap_mode='r'),
+                                                              shards=self.shards))
+            print('Loading done!')
+            # examples based on the model were already collected (loaded)
+            self.skip_first_self_play = True
+            return
+
         modelFile = os.path.join(self.args['load_folder_file'][0], self.args['load_folder_file'][1])
         examplesFile = modelFile + ".examples"
         if not os.path.isfile(examplesFile):
@@ -156,9 +320,58 @@ class Coach():
             # log.info("File with trainExamples found. Loading it...")
             print("File with train_examples found. Loading it...")
             with open(examplesFile, "rb") as f:
-                self.train_examples_history = Unpickler(f).load()
+                history = Unpickler(f).load()
+            # a list of deques of (board, pi, v) saved before the replay buffer
+            self.replay_buffer = self.make_replay_buffer()
+            for examples in history:
+                self.replay_buffer.add_iteration(examples)
+            self.write_shards([None] * self.replay_buffer.num_iterations)
+            if self.args.get('memmap_examples', False):
+                self.replay_buffer = self.make_replay_buffer()
             # log.info('Loading done!')
             print('Loading done!')
 
             # examples based on the model were already collected (loaded)
             self.skip_first_self_play = True
+
+    def write_shards(self, iterations):
+        """
+        Writes every iteration of the replay buffer as a new shard of the
+        checkpoint folder, for windows loaded from a pickle.
+
+        iterations: the iteration numbers of the shards, None where unknown
+        """
+        self.shards = deque()
+        for index, iteration in enumerate(iterations):
+            self.shards.append(self.shard_store.write(iteration, *self.replay_buffer.get_iteration(index), shards=self.shards))
+
+
+def self_play_worker(seed, episode_ids, game, nnet_class, state_dict, args, results, client=None):
+    """
+    Entry point of a self-play process started by Coach.execute_episodes_parallel.
+    Loads state_dict into a network of its own (or evaluates through client,
+    an InferenceClient, when given) and puts (episode_id, examples,
+    search_stats, cache_stats) on results for every episode it plays, where
+    search_stats are the episode's SearchStats as a dict and cache_stats are
+    the counters of the worker's EvalCache after its last episode and None
+    otherwise.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.set_num_threads(args.get('worker_threads', 1))
+
+    if client is not None:
+        nnet = client
+    else:
+        nnet = nnet_class(game)
+        nnet.nnet.load_state_dict(state_dict)
+    coach = Coach(game, nnet, args)
+    if coach.eval_cache is not None:
+        nnet = CachedNNet(nnet, coach.eval_cache)
+    for episode_id in episode_ids:
+        coach.mcts = make_mcts(game, nnet, args)  # reset search tree
+        examples = coach.execute_episode()
+        last = episode_id == episode_ids[-1]
+        results.put((episode_id, examples, coach.mcts.stats.as_dict(),
+                     coach.eval_cache.stats() if last and coach.eval_cache else None))
@@ -0,0 +1,405 @@
+import time
+
+import numpy as np
+from numba import njit, types
+from numba.typed import Dict
+
+import connect4.connect4 as connect4
+import tictactoe.tictactoe as tictactoe
+from connect4.connect4_bitboard import Connect4Bitboard
+from mcts import ArrayMCTS, puct_select
+
+# rules the compiled search plays: whether discs drop to the lowest empty cell
+# of the chosen column, how many in a row win, and the Zobrist table of the
+# game's get_hash
+RULES = {
+    connect4.Connect4: (True, 4, connect4.ZOBRIST),
+    Connect4Bitboard: (True, 4, connect4.ZOBRIST),
+    tictactoe.TicTacToe: (False, tictactoe.N, tictactoe.ZOBRIST),
+}
+
+
+@njit(cache=True)
+def _hash(board, zobrist):
+    # game.get_hash of a flat canonical board
+    side = np.count_nonzero(board) % 2
+    key = np.int64(side)
+    for cell in range(len(board)):
+        if board[cell] != 0:
+            mark = board[cell] if side == 0 else -board[cell]
+            key ^= zobrist[cell, 1 if mark < 0 else 0]
+    return key
+
+
+@njit(cache=True)
+def _target_cell(board, action, rows, cols, gravity):
+    if not gravity:
+        return action
+    row = rows - 1
+    while board[row * cols + action] != 0:
+        row -= 1
+    return row * cols + action
+
+
+@njit(cache=True)
+def _is_win_at(board, cell, rows, cols, win_length):
+    # whether the +1 mark at cell completes win_length in a row
+    row, col = cell // cols, cell % cols
+    for dr, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        length = 1
+        for sign in (1, -1):
+            r, c = row + sign * dr, col + sign * dc
+            while 0 <= r < rows and 0 <= c < cols and board[r * cols + c] == 1:
+                length += 1
+                r, c = r + sign * dr, c + sign * dc
+        if length >= win_length:
+            return True
+    return False
+
+
+@njit(cache=True)
+def _valid_actions(board, valid, cols, gravity):
+    # game.get_valid_actions: open columns (or empty cells), then the pass action once none is left
+    num_actions = cols if gravity else len(board)
+    any_valid = False
+    for a in range(num_actions):
+        valid[a] = board[a] == 0  # with gravity, cell a is the top of column a
+        any_valid |= valid[a]
+    valid[num_actions] = not any_valid
+
+
+@njit(cache=True)
+def _child(node, a, boards, keys, outcomes, node_ids, num_nodes, zobrist, rows, cols, gravity, win_length):
+    # the node reached by action a, added with its outcome unless a transposition already holds it
+    cell = _target_cell(boards[node], a, rows, cols, gravity)
+    key = keys[node] ^ zobrist[cell, keys[node] & 1] ^ 1
+    if key in node_ids:
+        return node_ids[key], False
+
+    child = num_nodes[0]
+    num_nodes[0] += 1
+    board = boards[child]
+    board[:] = boards[node]
+    board[cell] = 1
+    if _is_win_at(board, cell, rows, cols, win_length):
+        outcomes[child] = -1.
+    elif np.count_nonzero(board) == len(board):
+        outcomes[child] = 1e-4
+    else:
+        outcomes[child] = 0.
+    board *= -1  # canonical for the player to move next
+    keys[child] = key
+    node_ids[key] = child
+    return child, True
+
+
+@njit(cache=True)
+def _descend(root, k, cpuct, virtual_loss, Nsa, Wsa, Ps, valid, children, Ns, outcomes, expanded, boards, keys,
+             node_ids, num_nodes, zobrist, rows, cols, gravity, win_length, paths, path_lens, path_values,
+             path_leaves, leaves):
+    """
+    Descends k paths from root with virtual loss, adding the nodes they reach.
+    Path i is paths[i, :path_lens[i]] of (node, action) rows and ends either
+    at a terminal node, with path_values[i] the value of its last edge, or at
+    the unexpanded node leaves[path_leaves[i]].
+
+    Returns:
+        the number of distinct leaves to evaluate, the number of nodes added
+    """
+    num_leaves = 0
+    added = 0
+    for i in range(k):
+        node = root
+        depth = 0
+        path_leaves[i] = -1
+        while True:
+            if outcomes[node] != 0:
+                path_values[i] = -outcomes[node]
+                break
+            if not expanded[node]:
+                slot = 0
+                while slot < num_leaves and leaves[slot] != node:
+                    slot += 1
+                if slot == num_leaves:
+                    leaves[slot] = node
+                    num_leaves += 1
+                path_leaves[i] = slot
+                break
+            a = puct_select(Nsa[node], Wsa[node], Ps[node], valid[node], Ns[node], cpuct)
+            paths[i, depth, 0] = node
+            paths[i, depth, 1] = a
+            depth += 1
+            Nsa[node, a] += virtual_loss
+            Wsa[node, a] -= virtual_loss
+            Ns[node] += virtual_loss
+            child = children[node, a]
+            if child < 0:
+                child, new = _child(node, a, boards, keys, outcomes, node_ids, num_nodes, zobrist, rows, cols,
+                                    gravity, win_length)
+                children[node, a] = child
+                added += new
+            node = child
+        path_lens[i] = depth
+    return num_leaves, added
+
+
+@njit(cache=True)
+def _expand_and_backup(k, virtual_loss, Nsa, Wsa, Ps, valid, Ns, expanded, boards, cols, gravity, paths, path_lens,
+                       path_values, path_leaves, leaves, num_leaves, pis, vs):
+    """
+    Sets the priors of the evaluated leaves (uniform over the valid actions
+    when the network gives them no mass) and backs the k paths of _descend up,
+    leaving in path_values[i] the value path i brought to root.
+
+    Returns:
+        the number of leaves whose priors had to be made uniform
+    """
+    masked = 0
+    for j in range(num_leaves):
+        leaf = leaves[j]
+        _valid_actions(boards[leaf], valid[leaf], cols, gravity)
+        total = 0.
+        for a in range(Ps.shape[1]):
+            Ps[leaf, a] = pis[j, a] * valid[leaf, a]
+            total += Ps[leaf, a]
+        if total > 0:
+            Ps[leaf] /= total
+        else:
+            masked += 1
+            Ps[leaf] = valid[leaf] / np.count_nonzero(valid[leaf])
+        expanded[leaf] = True
+
+    for i in range(k):
+        v = path_values[i] if path_leaves[i] < 0 else -np.float64(vs[path_leaves[i]])
+        for d in range(path_lens[i] - 1, -1, -1):
+            node, a = paths[i, d, 0], paths[i, d, 1]
+            Wsa[node, a] += v + virtual_loss
+            Nsa[node, a] += 1 - virtual_loss
+            Ns[node] += 1 - virtual_loss
+            v = -v
+        path_values[i] = v
+    return masked
+
+
+@njit(cache=True)
+def _reroot(root, num_nodes, Nsa, Wsa, Ps, valid, children, Ns, outcomes, expanded, boards, keys, node_ids):
+    """
+    Keeps the subtree of root (nothing when root is -1), compacted to the
+    front of the pool in node order, and indexes its keys in the empty
+    node_ids.
+
+    Returns:
+        the number of nodes kept
+    """
+    keep = np.zeros(num_nodes, dtype=np.bool_)
+    if root >= 0:
+        stack = np.empty(num_nodes, dtype=np.int64)
+        stack[0] = root
+        keep[root] = True
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            for child in children[node]:
+                if child >= 0 and not keep[child]:
+                    keep[child] = True
+                    stack[top] = child
+                    top += 1
+
+    new_ids = np.full(num_nodes, -1, dtype=np.int32)
+    kept = 0
+    for old in range(num_nodes):
+        if keep[old]:
+            new_ids[old] = kept
+            if old != kept:
+                Nsa[kept] = Nsa[old]
+                Wsa[kept] = Wsa[old]
+                Ps[kept] = Ps[old]
+                valid[kept] = valid[old]
+                children[kept] = children[old]
+                Ns[kept] = Ns[old]
+                outcomes[kept] = outcomes[old]
+                expanded[kept] = expanded[old]
+                boards[kept] = boards[old]
+                keys[kept] = keys[old]
+            kept += 1
+
+    for node in range(kept):
+        for a in range(children.shape[1]):
+            if children[node, a] >= 0:
+                children[node, a] = new_ids[children[node, a]]
+        node_ids[keys[node]] = node
+    Nsa[kept:num_nodes] = 0
+    Wsa[kept:num_nodes] = 0
+    Ps[kept:num_nodes] = 0
+    valid[kept:num_nodes] = False
+    children[kept:num_nodes] = -1
+    Ns[kept:num_nodes] = 0
+    outcomes[kept:num_nodes] = 0
+    expanded[kept:num_nodes] = False
+    return kept
+
+
+class CompiledMCTS(ArrayMCTS):
+    """
+    ArrayMCTS whose whole simulation loop (PUCT selection, game steps, outcome
+    checks, transpositions and backup) runs in numba-compiled code over the
+    node pool, for the games in RULES. Paths are kept on an explicit stack, so
+    there is no recursion, and Python only takes over to send the leaves of a
+    batch of args['mcts_batch_size'] paths to the network.
+
+    It runs the same algorithm as ArrayMCTS, keyed by the same Zobrist hashes,
+    with the priors normalized in compiled code.
+    """
+
+    def __init__(self, game, nnet, args):
+        if game not in RULES:
+            raise ValueError(f'CompiledMCTS has no compiled rules for {game.__name__}')
+        super().__init__(game, nnet, args)
+        self.rows, self.cols = game.get_board_size()
+        gravity, self.win_length, zobrist = RULES[game]
+        self.gravity = gravity
+        self.zobrist = np.array(zobrist, dtype=np.int64)
+
+        # the compiled code reads states and keys from the pool instead of ArrayMCTS's lists
+        capacity = len(self.Ns)
+        del self.states
+        self.boards = np.zeros((capacity, self.rows * self.cols), dtype=np.int8)  # flat canonical board of node
+        self.keys = np.zeros(capacity, dtype=np.int64)  # Zobrist key of node
+        self.node_ids = Dict.empty(key_type=types.int64, value_type=types.int64)  # key -> node id
+        self.num_nodes = np.zeros(1, dtype=np.int64)  # in an array so the compiled code can update it
+
+        self.batch_size = max(self.args.get('mcts_batch_size', 1), 1)
+        self._allocate_paths(self.batch_size)
+
+    POOL = ArrayMCTS.POOL + (('boards', 0), ('keys', 0))
+
+    def _allocate_paths(self, k):
+        # path stack of a batch of k simulations: a game lasts at most one move per cell
+        self.paths = np.zeros((k, self.rows * self.cols + 1, 2), dtype=np.int64)
+        self.path_lens = np.zeros(k, dtype=np.int64)
+        self.path_values = np.zeros(k, dtype=np.float64)
+        self.path_leaves = np.zeros(k, dtype=np.int64)
+        self.leaves = np.zeros(k, dtype=np.int64)
+
+    def _root(self, canonicalBoard):
+        """
+        Returns the node of canonicalBoard, added to the pool if needed.
+        """
+        board = np.asarray(canonicalBoard, dtype=np.int8).reshape(-1)
+        key = _hash(board, self.zobrist)
+        node = self.node_ids.get(key, -1)
+        if node >= 0:
+            return node
+        if self.num_nodes[0] == len(self.Ns):
+            self._grow()
+        node = self.num_nodes[0]
+        self.num_nodes[0] += 1
+        self.boards[node] = board
+        self.keys[node] = key
+        self.outcomes[node] = self.game.get_game_outcome(canonicalBoard, 1)
+        self.node_ids[key] = node
+        self.stats.nodes += 1
+        return node
+
+    def reroot(self, canonicalBoard):
+        """
+        Makes canonicalBoard the root of the tree, freeing every node outside
+        its subtree, as ArrayMCTS.reroot does.
+        """
+        key = _hash(np.asarray(canonicalBoard, dtype=np.int8).reshape(-1), self.zobrist)
+        root = self.node_ids.get(key, -1)
+        self.node_ids = Dict.empty(key_type=types.int64, value_type=types.int64)
+        self.num_nodes[0] = _reroot(root, self.num_nodes[0], self.Nsa, self.Wsa, self.Ps, self.valid, self.children,
+                                    self.Ns, self.outcomes, self.expanded, self.boards, self.keys, self.node_ids)
+
+    def _simulate(self, root, k):
+        """
+        Runs k simulations from root with one network call for their leaves.
+        """
+        if k > len(self.path_lens):
+            self._allocate_paths(k)
+        while self.num_nodes[0] + k >= len(self.Ns):
+            self._grow()
+        virtual_loss = self.args.get('virtual_loss', 1) if k > 1 else 0
+        num_leaves, added = _descend(
+            root, k, float(self.args['cpuct']), virtual_loss, self.Nsa, self.Wsa, self.Ps, self.valid, self.children,
+            self.Ns, self.outcomes, self.expanded, self.boards, self.keys, self.node_ids, self.num_nodes, self.zobrist,
+            self.rows, self.cols, self.gravity, self.win_length, self.paths, self.path_lens, self.path_values,
+            self.path_leaves, self.leaves)
+
+        pis = np.zeros((0, self.action_size), dtype=np.float32)
+        vs = np.zeros(0, dtype=np.float32)
+        if num_leaves:
+            boards = self.boards[self.leaves[:num_leaves]].reshape(num_leaves, self.rows, self.cols)
+            if hasattr(self.nnet, 'predict_batch'):
+                pis, vs = self.nnet.predict_batch(boards)
+            else:
+                pis, vs = zip(*[self.nnet.predict(board) for board in boards])
+                pis, vs = np.stack(pis), np.array([np.asarray(v).item() for v in vs])
+            self.stats.nnet_calls += 1
+
+        masked = _expand_and_backup(k, virtual_loss, self.Nsa, self.Wsa, self.Ps, self.valid, self.Ns, self.expanded,
+                                    self.boards, self.cols, self.gravity, self.paths, self.path_lens,
+                                    self.path_values, self.path_leaves, self.leaves, num_leaves,
+                                    np.asarray(pis, dtype=np.float64), np.asarray(vs, dtype=np.float64).reshape(-1))
+        if masked:
+            print("All valid moves were masked, settings all valid moves to be equally probably. Check if your NNet architecture is insufficient or you've get overfitting!")
+        self.stats.nodes += added
+        self.stats.depth += int(self.path_lens[:k].sum())
+
+    def search(self, cannonical_state, outcome=None, key=None):
+        """
+        Runs one simulation from cannonical_state, like ArrayMCTS.search.
+        outcome and key are recomputed by the compiled code, so they are ignored.
+
+        Returns:
+            the value of the simulation for the player who moved into cannonical_state
+        """
+        self._simulate(self._root(cannonical_state), 1)
+        return float(self.path_values[0])
+
+    def search_batch(self, cannonical_state, k, key=None):
+        """
+        Runs k simulations with one network call, like ArrayMCTS.search_batch.
+        key is recomputed by the compiled code, so it is ignored.
+
+        Returns:
+            the number of simulations performed (k, or 1 when only the root
+            had to be expanded)
+        """
+        root = self._root(cannonical_state)
+        if self.outcomes[root] == 0 and not self.expanded[root]:
+            # every path would stop at the root, so evaluate it on its own
+            self._simulate(root, 1)
+            return 1
+        self._simulate(root, k)
+        return k
+
+    def _compiled_only(self, *args, **kwargs):
+        raise NotImplementedError('CompiledMCTS keeps no Python states, nodes are added and expanded by the '
+                                  'compiled search')
+
+    # ArrayMCTS steps that read the states list, replaced by the compiled kernels
+    _add_node = _child = _expand = _set_priors = _compiled_only
+
+    def run_simulations(self, canonicalBoard, num_sims, reroot=True):
+        start = time.time()
+        if reroot and self.args.get('reuse_tree', False):
+            self.reroot(canonicalBoard)
+        root = self._root(canonicalBoard)
+        done = 0
+        while done < num_sims:
+            # an unexpanded root would end every path of a batch, so it is evaluated on its own
+            k = min(self.batch_size, num_sims - done) if self.expanded[root] else 1
+            self._simulate(root, k)
+            done += k
+        self.stats.simulations += done
+        self.stats.seconds += time.time() - start
+
+    def get_counts(self, canonicalBoard):
+        key = _hash(np.asarray(canonicalBoard, dtype=np.int8).reshape(-1), self.zobrist)
+        node = self.node_ids.get(key, -1)
+        if node < 0:
+            return [0] * self.action_size
+        return self.Nsa[node].tolist()
@@ -10,6 +10,11 @@ diag1_kernel = np.eye(4, dtype=np.int8)
 diag2_kernel = np.fliplr(diag1_kernel)
 detection_kernels = [horizontal_kernel, vertical_kernel, diag1_kernel, diag2_kernel]
 
+# random key of every (cell, player 1 / player -1) pair; bit 0 is kept free
+# for the side to move, see Connect4.get_hash
+ZOBRIST = [[int(x) & ~1 for x in cell] for cell in
+           np.random.default_rng(ROWS * COLS).integers(0, 2**63, size=(ROWS * COLS, 2), dtype=np.uint64)]
+
 
 class Connect4:
     """
@@ -44,6 +49,42 @@ class Connect4:
         Connect4._add_move(s, action, player)
         return s, -player
     
+    @staticmethod
+    def step(state: np.ndarray, action: int, player: int) -> tuple[np.ndarray, int, int]:
+        """
+        get_next_state followed by get_game_outcome(next_state, next_player),
+        checking only the lines through the new disc. state must not be
+        terminal yet.
+        """
+        if not 0 <= action < COLS or state[0][action] != 0:
+            next_state, next_player = Connect4.get_next_state(state, action, player)
+            return next_state, next_player, Connect4.get_game_outcome(next_state, next_player)
+
+        s = state.copy()
+        row = ROWS - 1
+        while s[row][action] != 0:
+            row -= 1
+        s[row][action] = player
+
+        if Connect4._is_win_at(s, row, action, player):
+            return s, -player, -1
+        if not (s[0] == 0).any():
+            return s, -player, 1e-4
+        return s, -player, 0
+
+    @staticmethod
+    def _is_win_at(state: np.ndarray, row: int, col: int, player: int) -> bool:
+        for dr, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+            length = 1
+            for sign in (1, -1):
+                r, c = row + sign * dr, col + sign * dc
+                while 0 <= r < ROWS and 0 <= c < COLS and state[r][c] == player:
+                    length += 1
+                    r, c = r + sign * dr, c + sign * dc
+            if length >= 4:
+                return True
+        return False
+
     @staticmethod
     def get_valid_actions(state: np.ndarray) -> np.ndarray:
         valid = (state[0] == 0).astype(int)
@@ -73,7 +114,8 @@ class Connect4:
     @staticmethod
     def get_symmetries(board, pi):
         """Board is left/right board symmetric"""
-        return [(board, pi), (board[:, ::-1], pi[::-1])]
+        # mirror the column probabilities only, the pass action stays last
+        return [(board, pi), (board[:, ::-1], np.append(np.asarray(pi)[-2::-1], pi[-1]))]
 
     @staticmethod
     def get_cannonical_state(state: np.ndarray, player: int) -> np.ndarray:
@@ -98,4 +140,28 @@ class Connect4:
 
     @staticmethod
     def state_to_string(state: np.ndarray) -> str:
-        return state.tostring()
\ No newline at end of file
+        return state.tobytes()
+
+    @staticmethod
+    def get_hash(state: np.ndarray) -> int:
+        """
+        64-bit Zobrist key of a canonical state. Player 1 moves first, so the
+        number of discs tells whether the player to move (+1 in the canonical
+        state) is player 1 or -1; the key hashes the board in player 1/-1
+        terms and stores the side to move in bit 0.
+        """
+        side = int(np.count_nonzero(state) % 2)  # 0: player 1 to move, 1: player -1 to move
+        board = (state if side == 0 else -state).reshape(-1)
+        key = side
+        for cell in np.flatnonzero(board):
+            key ^= ZOBRIST[cell][int(board[cell] < 0)]
+        return key
+
+    @staticmethod
+    def get_next_hash(key: int, state: np.ndarray, action: int) -> int:
+        """
+        get_hash of the canonical state reached by playing action in the
+        canonical state, whose key is key, in O(1) (one column lookup).
+        """
+        row = ROWS - 1 - np.count_nonzero(state[:, action])
+        return key ^ ZOBRIST[row * COLS + action][key & 1] ^ 1
\ No newline at end of file
@@ -0,0 +1,146 @@
+import numpy as np
+
+from connect4.connect4 import Connect4
+
+ROWS = 6
+COLS = 7
+H = ROWS + 1  # bits per column: ROWS cells plus an always empty sentinel bit
+
+# bit of cell (row, col) is col * H + (ROWS - 1 - row), i.e. columns bottom-up
+CELL_BITS = np.array([[1 << (col * H + ROWS - 1 - row) for col in range(COLS)] for row in range(ROWS)], dtype=np.uint64)
+BOTTOM = [1 << (col * H) for col in range(COLS)]
+TOP = [1 << (col * H + ROWS - 1) for col in range(COLS)]
+COLUMN = [((1 << ROWS) - 1) << (col * H) for col in range(COLS)]
+FULL = sum(COLUMN)
+
+
+class BitboardState(tuple):
+    """
+    A Connect 4 position as (discs of player 1, discs of player -1) bitmasks.
+    np.asarray(state) gives the same [ROWS, COLS] board as Connect4 uses, which
+    is what the network consumes.
+    """
+    __slots__ = ()
+
+    def __new__(cls, p1, p2):
+        return tuple.__new__(cls, (p1, p2))
+
+    def __getnewargs__(self):
+        # tuple's passes the whole tuple as one argument, pickle and copy need p1, p2
+        return tuple(self)
+
+    def __array__(self, dtype=None, copy=None):
+        board = Connect4Bitboard.to_array(self)
+        return board if dtype is None else board.astype(dtype)
+
+
+class Connect4Bitboard:
+    """
+    The game of Connect 4 on bitboards, with the same static interface as
+    Connect4. Each player's discs are one integer mask with a sentinel bit on
+    top of every column, so a move is a single addition (the lowest empty cell
+    of a column is mask + bottom bit, which makes column heights implicit) and
+    four in a row is two shift-and-ANDs per direction.
+    """
+
+    @staticmethod
+    def get_action_size() -> int:
+        return COLS + 1
+
+    @staticmethod
+    def get_initial_state() -> BitboardState:
+        return BitboardState(0, 0)
+
+    @staticmethod
+    def get_board_size() -> tuple:
+        return (ROWS, COLS)
+
+    @staticmethod
+    def get_next_state(state: BitboardState, action: int, player: int) -> tuple[BitboardState, int]:
+        if action == COLS:
+            return (state, -player)
+        p1, p2 = state
+        move = ((p1 | p2) + BOTTOM[action]) & COLUMN[action]  # 0 if the column is full
+        if player == 1:
+            return BitboardState(p1 | move, p2), -player
+        return BitboardState(p1, p2 | move), -player
+
+    @staticmethod
+    def step(state: BitboardState, action: int, player: int) -> tuple[BitboardState, int, int]:
+        """
+        get_next_state followed by get_game_outcome(next_state, next_player),
+        checking only the mover's discs. state must not be terminal yet.
+        """
+        next_state, next_player = Connect4Bitboard.get_next_state(state, action, player)
+        if Connect4Bitboard._is_win(next_state[0] if player == 1 else next_state[1]):
+            return next_state, next_player, -1
+        if next_state[0] | next_state[1] == FULL:
+            return next_state, next_player, 1e-4
+        return next_state, next_player, 0
+
+    @staticmethod
+    def get_valid_actions(state: BitboardState) -> np.ndarray:
+        mask = state[0] | state[1]
+        valid = np.array([not mask & top for top in TOP], dtype=int)
+        game_over = int(mask == FULL)
+        return np.append(valid, game_over)
+
+    @staticmethod
+    def _is_win(discs: int) -> bool:
+        for shift in (1, H, H - 1, H + 1):  # vertical, horizontal, both diagonals
+            pairs = discs & (discs >> shift)
+            if pairs & (pairs >> 2 * shift):
+                return True
+        return False
+
+    @staticmethod
+    def get_game_outcome(state: BitboardState, player: int) -> int:
+        mine, theirs = state if player == 1 else (state[1], state[0])
+        if not mine | theirs:
+            return 0
+        if Connect4Bitboard._is_win(mine):
+            return 1
+        if Connect4Bitboard._is_win(theirs):
+            return -1
+        if mine | theirs == FULL:
+            return 1e-4
+
+        return 0
+
+    @staticmethod
+    def get_symmetries(board, pi):
+        return Connect4.get_symmetries(np.asarray(board), pi)
+
+    @staticmethod
+    def get_cannonical_state(state: BitboardState, player: int) -> BitboardState:
+        if player == 1:
+            return state
+        return BitboardState(state[1], state[0])
+
+    @staticmethod
+    def to_array(state: BitboardState) -> np.ndarray:
+        p1, p2 = np.uint64(state[0]), np.uint64(state[1])
+        return (CELL_BITS & p1 != 0).astype(int) - (CELL_BITS & p2 != 0)
+
+    @staticmethod
+    def visualize_state(state: BitboardState) -> None:
+        Connect4.visualize_state(Connect4Bitboard.to_array(state))
+
+    @staticmethod
+    def state_to_string(state: BitboardState) -> tuple:
+        return state
+
+    @staticmethod
+    def get_hash(state: BitboardState) -> int:
+        """
+        Exact key of a canonical state: the discs of the player to move plus
+        all discs, which is unique and fits in COLS * H bits.
+        """
+        return state[0] + (state[0] | state[1])
+
+    @staticmethod
+    def get_next_hash(key: int, state: BitboardState, action: int) -> int:
+        mine, theirs = state
+        move = ((mine | theirs) + BOTTOM[action]) & COLUMN[action]
+        # the player to move swaps: their discs become "mine" and all discs gain the move
+        return theirs + (mine | theirs | move)
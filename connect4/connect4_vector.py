@@ -0,0 +1,28 @@
+from connect4.connect4 import Connect4
+from vector_env import VectorEnv
+
+
+class Connect4Vector(VectorEnv):
+    """
+    Many games of Connect 4 in lockstep, see VectorEnv.
+    """
+    game = Connect4
+
+    def _empty_actions(self):
+        return self.states[:, 0] == 0
+
+    def _place(self, games, actions, players):
+        columns = self.states[games, :, actions]  # [len(games), ROWS]
+        rows = (columns == 0).sum(1) - 1  # lowest empty cell of every chosen column
+        self.states[games, rows, actions] = players
+
+    def _is_win(self, discs):
+        # discs: [n, ROWS, COLS] bool, four in a row along any direction
+        horizontal = discs[:, :, :-3] & discs[:, :, 1:-2] & discs[:, :, 2:-1] & discs[:, :, 3:]
+        vertical = discs[:, :-3] & discs[:, 1:-2] & discs[:, 2:-1] & discs[:, 3:]
+        diag1 = discs[:, :-3, :-3] & discs[:, 1:-2, 1:-2] & discs[:, 2:-1, 2:-1] & discs[:, 3:, 3:]
+        diag2 = discs[:, :-3, 3:] & discs[:, 1:-2, 2:-1] & discs[:, 2:-1, 1:-2] & discs[:, 3:, :-3]
+        return horizontal.any((1, 2)) | vertical.any((1, 2)) | diag1.any((1, 2)) | diag2.any((1, 2))
+
+    def _is_full(self, states):
+        return (states[:, 0] != 0).all(1)
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EvalCache():
+    """
+    LRU cache of network evaluations, keyed by network version and position.
+
+    Positions are normalized under the symmetries of game.get_symmetries: all
+    symmetric boards share one entry, stored for the symmetric board whose
+    bytes sort first, and the policy is permuted back when a lookup matches
+    through a symmetry. Bump version whenever the network's weights change.
+    """
+
+    def __init__(self, game, max_size):
+        self.game = game
+        self.max_size = max_size
+        self.version = 0
+        self.entries = OrderedDict()  # (version, board bytes) -> (pi, v)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.entries)}
+
+    def _key(self, board):
+        """
+        Returns:
+            key: cache key of the symmetry class of board
+            perm: policy permutation with pi_sym = pi[perm] for the keyed board
+        """
+        syms = self.game.get_symmetries(board, np.arange(self.game.get_action_size()))
+        keys = [np.asarray(b, dtype=np.int8).tobytes() for b, _ in syms]
+        i = min(range(len(keys)), key=keys.__getitem__)
+        return (self.version, keys[i]), np.asarray(syms[i][1])
+
+    def get(self, board):
+        """
+        Returns:
+            (pi, v) for board, or None (and the key to put it under) on a miss
+        """
+        key, perm = self._key(board)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, (key, perm)
+        self.hits += 1
+        self.entries.move_to_end(key)
+        pi_sym, v = entry
+        pi = np.empty_like(pi_sym)
+        pi[perm] = pi_sym
+        return (pi, v), None
+
+    def put(self, key_perm, pi, v):
+        key, perm = key_perm
+        self.entries[key] = (pi[perm], v)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+class CachedNNet():
+    """
+    Wraps an NNetWrapper (or anything with predict/predict_batch) so that its
+    evaluations go through an EvalCache.
+    """
+
+    def __init__(self, nnet, cache):
+        self.nnet = nnet
+        self.cache = cache
+
+    def predict(self, board):
+        pi, v = self.predict_batch(np.asarray(board)[np.newaxis])
+        return pi[0], v[:1]
+
+    def predict_batch(self, boards):
+        pis = np.empty((len(boards), self.cache.game.get_action_size()), dtype=np.float32)
+        vs = np.empty(len(boards), dtype=np.float32)
+        misses = []
+        for i, board in enumerate(boards):
+            entry, key_perm = self.cache.get(board)
+            if entry is None:
+                misses.append((i, key_perm))
+            else:
+                pis[i], vs[i] = entry
+
+        if misses:
+            ids = [i for i, _ in misses]
+            miss_pis, miss_vs = self.nnet.predict_batch(np.asarray(boards)[ids])
+            pis[ids] = miss_pis
+            vs[ids] = miss_vs
+            for (_, key_perm), pi, v in zip(misses, miss_pis, miss_vs):
+                self.cache.put(key_perm, pi, v)
+        return pis, vs
+
+
+def format_cache_stats(stats):
+    lookups = stats['hits'] + stats['misses']
+    return (f"Eval cache: {stats['hits']} hits / {lookups} lookups ({100 * stats['hits'] / max(lookups, 1):.1f}%), "
+            f"size {stats['size']}, {stats['evictions']} evictions")
@@ -0,0 +1,47 @@
+import sys
+
+import torch
+
+from inference import benchmark, check_parity, export, random_positions
+
+# from tictactoe.tictactoe import TicTacToe as Game
+# from tictactoe.tictactoe_network import NNetWrapper as nn_wrapper
+from connect4.connect4 import Connect4 as Game
+from connect4.connect4_network import NNetWrapper as nn_wrapper
+
+args = {
+    'checkpoint': ('./checkpoints/connect4', 'best.pth.tar'),
+    'export_file': './checkpoints/connect4/best.pt',  # where the frozen inference model is saved
+    'parity_positions': 256,       # Random positions compared between the eager and the frozen model.
+    'parity_tolerance': 1e-4,      # Largest log pi or v difference accepted; the export fails beyond it.
+    'batch_sizes': (1, 8, 64),     # Batch sizes of the latency benchmark.
+    'benchmark_seconds': 2,        # Time spent measuring each batch size per model.
+}
+
+
+def main():
+    game = Game
+    nnet = nn_wrapper(game)
+    nnet.load_checkpoint(*args['checkpoint'])
+
+    export(nnet, args['export_file'])
+    print(f'Frozen inference model saved to {args["export_file"]}')
+    device = next(nnet.nnet.parameters()).device
+    frozen = torch.jit.load(args['export_file'], map_location=device)
+
+    boards = random_positions(game, max(args['parity_positions'], max(args['batch_sizes'])))
+    pi_diff, v_diff = check_parity(nnet, frozen, boards[:args['parity_positions']])
+    print(f'Parity on {args["parity_positions"]} positions: max |log pi| diff {pi_diff:.2e}, max |v| diff {v_diff:.2e}')
+    if max(pi_diff, v_diff) > args['parity_tolerance']:
+        print(f'The frozen model differs from the checkpoint by more than {args["parity_tolerance"]:.0e}')
+        sys.exit(1)
+
+    eager = benchmark(nnet.nnet.eval(), boards, args['batch_sizes'], args['benchmark_seconds'], device)
+    fused = benchmark(frozen, boards, args['batch_sizes'], args['benchmark_seconds'], device)
+    print('batch   eager ms  frozen ms  speedup')
+    for batch_size in args['batch_sizes']:
+        print(f'{batch_size:5d}  {eager[batch_size]:9.3f}  {fused[batch_size]:9.3f}  {eager[batch_size] / fused[batch_size]:6.2f}x')
+
+
+if __name__ == "__main__":
+    main()
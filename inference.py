@@ -0,0 +1,151 @@
+import copy
+import time
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def fold_batchnorm(layer, bn):
+    """
+    Returns a copy of layer (Conv2d or Linear) with the eval-mode BatchNorm bn
+    that follows it folded into its weights and bias.
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    fused = copy.deepcopy(layer)
+    with torch.no_grad():
+        fused.weight.copy_(layer.weight * scale.view(-1, *([1] * (layer.weight.dim() - 1))))
+        fused.bias.copy_((layer.bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
+class FusedNN(nn.Module):
+    """
+    Inference-only version of Connect4NN/TicTacToeNN: every BatchNorm folded
+    into the conv or linear layer before it, no dropout, and log-probabilities
+    out of log_softmax, as the eager model returns them in eval mode.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.board_x, self.board_y = model.board_x, model.board_y
+        self.flat_size = model.args['num_channels'] * (self.board_x - 2) * (self.board_y - 2)
+        self.conv1 = fold_batchnorm(model.conv1, model.bn1)
+        self.conv2 = fold_batchnorm(model.conv2, model.bn2)
+        self.conv3 = fold_batchnorm(model.conv3, model.bn3)
+        self.conv4 = fold_batchnorm(model.conv4, model.bn4)
+        self.fc1 = fold_batchnorm(model.fc1, model.fc_bn1)
+        self.fc2 = fold_batchnorm(model.fc2, model.fc_bn2)
+        self.fc3 = copy.deepcopy(model.fc3)  # copies, so moving the fused model leaves model's heads alone
+        self.fc4 = copy.deepcopy(model.fc4)
+
+    def forward(self, s):
+        s = s.view(-1, 1, self.board_x, self.board_y)
+        s = F.relu(self.conv1(s))
+        s = F.relu(self.conv2(s))
+        s = F.relu(self.conv3(s))
+        s = F.relu(self.conv4(s))
+        s = s.view(-1, self.flat_size)
+        s = F.relu(self.fc1(s))
+        s = F.relu(self.fc2(s))
+        return F.log_softmax(self.fc3(s), dim=1), torch.tanh(self.fc4(s))
+
+
+def freeze(model):
+    """
+    Returns the frozen TorchScript module of FusedNN(model), for the weights
+    model has now.
+    """
+    fused = FusedNN(model.eval()).eval()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)  # newer torch deprecates TorchScript in favour of torch.compile
+        return torch.jit.freeze(torch.jit.script(fused))
+
+
+def quantize(model):
+    """
+    Returns the frozen TorchScript module of FusedNN(model) with its linear
+    layers dynamically quantized to int8 (weights stored as int8, activations
+    quantized on the fly), which is where most of the weights are. PyTorch has
+    no dynamic quantization of convolutions, those stay float. CPU only.
+    """
+    fused = FusedNN(model.eval()).cpu().eval()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # newer torch deprecates torch.ao.quantization and TorchScript
+        quantized = torch.ao.quantization.quantize_dynamic(fused, {nn.Linear}, dtype=torch.qint8)
+        return torch.jit.freeze(torch.jit.script(quantized))
+
+
+def export(nnet, filename, quantized=False):
+    """
+    Saves the frozen (or, with quantized, the int8 quantized) inference model
+    of the NNetWrapper nnet to filename, to be loaded by
+    NNetWrapper.load_inference_model.
+    """
+    torch.jit.save(quantize(nnet.nnet) if quantized else freeze(nnet.nnet), filename)
+
+
+def random_positions(game, num_positions, rng=None):
+    """
+    Returns [num_positions, rows, cols] canonical boards of random games.
+    """
+    rng = rng or np.random.default_rng(0)
+    boards = []
+    while len(boards) < num_positions:
+        state, player = game.get_initial_state(), 1
+        while len(boards) < num_positions:
+            board = game.get_cannonical_state(state, player)
+            boards.append(np.asarray(board))
+            valids = game.get_valid_actions(board)
+            state, player, r = game.step(state, rng.choice(np.flatnonzero(valids)), player)
+            if r != 0:
+                break
+    return np.array(boards)
+
+
+def compare(log_pis, vs, log_pis_ref, vs_ref):
+    """
+    Compares the outputs of a model with those of a reference model.
+
+    Returns:
+        mean and max policy KL(reference || model), mean and max value absolute error
+    """
+    kl = (log_pis_ref.exp() * (log_pis_ref - log_pis)).sum(dim=1)
+    error = (vs.view(-1) - vs_ref.view(-1)).abs()
+    return kl.mean().item(), kl.max().item(), error.mean().item(), error.max().item()
+
+
+def check_parity(nnet, frozen, boards):
+    """
+    Compares the eager network of nnet with a frozen inference model on boards.
+
+    Returns:
+        (max abs difference of log-probabilities, max abs difference of values)
+    """
+    x = torch.as_tensor(boards, dtype=torch.float32, device=next(nnet.nnet.parameters()).device)
+    nnet.nnet.eval()
+    with torch.no_grad():
+        pi, v = nnet.nnet(x)
+        pi_frozen, v_frozen = frozen(x)
+    return (pi - pi_frozen).abs().max().item(), (v - v_frozen).abs().max().item()
+
+
+def benchmark(model, boards, batch_sizes, seconds, device='cpu'):
+    """
+    Returns:
+        {batch size: mean latency of one call in milliseconds}
+    """
+    latencies = dict()
+    for batch_size in batch_sizes:
+        x = torch.as_tensor(boards[:batch_size], dtype=torch.float32, device=device)
+        with torch.no_grad():
+            for _ in range(3):  # warm up, TorchScript optimizes on the first calls
+                model(x)
+            calls, start = 0, time.time()
+            while time.time() - start < seconds:
+                model(x)
+                calls += 1
+        latencies[batch_size] = (time.time() - start) / calls * 1000
+    return latencies
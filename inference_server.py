@@ -0,0 +1,182 @@
+import multiprocessing as mp
+import queue
+import time
+from collections import Counter
+
+import numpy as np
+
+
+class InferenceServer():
+    """
+    A process that owns the network and evaluates positions for many MCTS
+    workers at once. Workers talk to it through InferenceClient proxies, which
+    offer the same predict/predict_batch interface as NNetWrapper.
+
+    Requests from all clients share one queue. The server blocks for the first
+    request, then keeps collecting until max_batch_size positions are waiting
+    or max_wait_us microseconds have passed, and evaluates everything it got
+    with a single predict_batch call.
+    """
+
+    def __init__(self, game, nnet_class, state_dict, num_clients, max_batch_size=64, max_wait_us=500, ctx=None):
+        """
+        Input:
+            game: Game class
+            nnet_class: NNetWrapper class to build the served network with
+            state_dict: weights of the served network
+            num_clients: number of InferenceClients to create
+            max_batch_size: positions after which a batch is evaluated without waiting
+            max_wait_us: how long the first request of a batch may wait for others
+        """
+        self.ctx = ctx or mp.get_context('spawn')
+        self.requests = self.ctx.Queue()
+        self.responses = [self.ctx.Queue() for _ in range(num_clients)]
+        self.stats_queue = self.ctx.Queue()
+        self.failed = self.ctx.Event()  # set when serve raises, so clients stop waiting
+        self.clients = [InferenceClient(i, self.requests, r, self.failed) for i, r in enumerate(self.responses)]
+        self.process = self.ctx.Process(target=serve, daemon=True,
+                                        args=(game, nnet_class, state_dict, self.requests, self.responses,
+                                              self.stats_queue, max_batch_size, max_wait_us, self.failed))
+
+    def start(self):
+        self.process.start()
+        return self
+
+    def stop(self):
+        """
+        Shuts the server down once the queued requests are served.
+
+        Returns:
+            stats: the InferenceStats collected by the server
+        """
+        self.requests.put(None)
+        while True:
+            try:
+                stats = self.stats_queue.get(timeout=1)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    try:
+                        stats = self.stats_queue.get_nowait()  # sent right before exiting
+                        break
+                    except queue.Empty:
+                        raise RuntimeError(f'The inference server exited with code {self.process.exitcode} '
+                                           'before sending its stats')
+        self.process.join()
+        return stats
+
+
+class InferenceClient():
+    """
+    Proxy for a network served by an InferenceServer. Each client sends one
+    request at a time and waits for its own response queue, so a client must
+    only be used by one process.
+    """
+
+    def __init__(self, client_id, requests, responses, server_failed):
+        self.client_id = client_id
+        self.requests = requests
+        self.responses = responses
+        self.server_failed = server_failed
+
+    def predict(self, board):
+        pi, v = self.predict_batch(np.asarray(board)[np.newaxis])
+        return pi[0], v[:1]
+
+    def predict_batch(self, boards):
+        self.requests.put((self.client_id, time.time(), np.asarray(boards)))
+        while True:
+            try:
+                return self.responses.get(timeout=1)
+            except queue.Empty:
+                if self.server_failed.is_set():
+                    raise RuntimeError('The inference server failed')
+
+
+class InferenceStats():
+    """
+    Batch sizes (in positions) and queue waits (time from a client sending a
+    request to its batch being evaluated) seen by an InferenceServer.
+    """
+
+    def __init__(self):
+        self.batch_sizes = Counter()  # positions per batch -> number of batches
+        self.wait_us = Counter()  # power of two bucket of the wait in microseconds -> number of requests
+        self.total_wait_us = 0
+        self.max_wait_us = 0
+        self.num_requests = 0
+
+    def update(self, batch_size, waits_us):
+        self.batch_sizes[batch_size] += 1
+        for wait in waits_us:
+            self.wait_us[1 << max(int(wait), 1).bit_length() - 1] += 1
+            self.total_wait_us += wait
+            self.max_wait_us = max(self.max_wait_us, wait)
+        self.num_requests += len(waits_us)
+
+    def __repr__(self):
+        num_batches = sum(self.batch_sizes.values())
+        num_positions = sum(size * n for size, n in self.batch_sizes.items())
+        lines = [f'{num_batches} batches, {num_positions} positions, '
+                 f'mean batch size {num_positions / max(num_batches, 1):.1f}']
+        lines.append('batch size histogram:')
+        for size in sorted(self.batch_sizes):
+            lines.append(f'  {size:6d} : {self.batch_sizes[size]}')
+        lines.append(f'queue wait: mean {self.total_wait_us / max(self.num_requests, 1):.0f}us, '
+                     f'max {self.max_wait_us:.0f}us')
+        for bucket in sorted(self.wait_us):
+            lines.append(f'  >= {bucket:8d}us : {self.wait_us[bucket]}')
+        return '\n'.join(lines)
+
+
+def serve(game, nnet_class, state_dict, requests, responses, stats_queue, max_batch_size, max_wait_us, failed):
+    """
+    Main loop of the InferenceServer process, setting failed if it raises.
+    """
+    try:
+        _serve(game, nnet_class, state_dict, requests, responses, stats_queue, max_batch_size, max_wait_us)
+    except BaseException:
+        failed.set()
+        raise
+
+
+def _serve(game, nnet_class, state_dict, requests, responses, stats_queue, max_batch_size, max_wait_us):
+    nnet = nnet_class(game)
+    nnet.nnet.load_state_dict(state_dict)
+    stats = InferenceStats()
+    max_wait = max_wait_us / 1e6
+    running = True
+
+    while running:
+        request = requests.get()
+        if request is None:
+            break
+        batch = [request]
+        size = len(request[2])
+        deadline = time.time() + max_wait
+
+        while size < max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                running = False
+                break
+            batch.append(request)
+            size += len(request[2])
+
+        start = time.time()
+        pis, vs = nnet.predict_batch(np.concatenate([boards for _, _, boards in batch]))
+        stats.update(size, [(start - sent) * 1e6 for _, sent, _ in batch])
+
+        i = 0
+        for client_id, _, boards in batch:
+            n = len(boards)
+            responses[client_id].put((pis[i:i + n], vs[i:i + n]))
+            i += n
+
+    stats_queue.put(stats)
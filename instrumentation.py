@@ -0,0 +1,105 @@
+import cProfile
+import csv
+import json
+import os
+import pstats
+import time
+from contextlib import contextmanager
+
+
+class IterationRecorder():
+    """
+    One record per Coach.learn iteration, appended to filename as a JSON line,
+    or as a CSV row when filename ends with .csv: the wall time of every
+    phase, the work of the iteration's searches and the size of the replay
+    window.
+    """
+    PHASES = ('self_play', 'save_examples', 'train', 'checkpoint_io', 'arena')
+    FIELDS = (('iteration', 'time') + tuple(f'{phase}_s' for phase in PHASES) +
+              ('simulations', 'sims_per_s', 'nodes', 'nnet_calls', 'avg_depth',
+               'replay_examples', 'replay_iterations', 'replay_bytes', 'replay_disk_bytes'))
+
+    def __init__(self, filename=None):
+        """
+        filename: where the records are appended, None to only keep the current one
+        """
+        self.filename = filename
+        self.record = None
+
+    def start(self, iteration):
+        self.record = {'iteration': iteration, 'time': time.time()}
+        for phase in self.PHASES:
+            self.record[f'{phase}_s'] = 0.
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Adds the wall time of the block to phase name of the current iteration.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record[f'{name}_s'] += time.time() - start
+
+    def search(self, stats):
+        """
+        stats: SearchStats of all the searches of the iteration, from every
+               self-play worker. sims_per_s is their throughput over the wall
+               time of the self_play phase, so it must be called after that
+               phase; stats.seconds is summed over the workers and would give
+               a per-worker rate instead.
+        """
+        wall_time = self.record['self_play_s']
+        self.record.update({
+            'simulations': stats.simulations,
+            'sims_per_s': stats.simulations / wall_time if wall_time else 0.,
+            'nodes': stats.nodes,
+            'nnet_calls': stats.nnet_calls,
+            'avg_depth': stats.depth / stats.simulations if stats.simulations else 0.,
+        })
+
+    def update(self, **fields):
+        self.record.update(fields)
+
+    def finish(self):
+        """
+        Appends the record of the current iteration to the file.
+        """
+        if self.filename is None:
+            return
+        folder = os.path.dirname(self.filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        if self.filename.endswith('.csv'):
+            new = not os.path.isfile(self.filename)
+            with open(self.filename, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=self.FIELDS, extrasaction='ignore')
+                if new:
+                    writer.writeheader()
+                writer.writerow(self.record)
+        else:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(self.record) + '\n')
+        self.record = None
+
+
+@contextmanager
+def profile(filename):
+    """
+    Runs the block under cProfile when filename is set, saving the stats to
+    filename (for pstats or snakeviz) and printing the top entries. With
+    filename None the block runs as is, e.g. to be sampled by py-spy.
+    """
+    if filename is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+        print(f'Profile saved to {filename}')
@@ -2,17 +2,41 @@ from coach import Coach
 # from tictactoe.tictactoe import TicTacToe as Game
 # from tictactoe.tictactoe_network import NNetWrapper as nn
 from connect4.connect4 import Connect4 as Game
+# from connect4.connect4_bitboard import Connect4Bitboard as Game
 from connect4.connect4_network import NNetWrapper as nn
 
 args = {
     'num_iters': 1000,
     'num_eps': 10,              # Number of complete self-play games to simulate during a new iteration.
+    'num_workers': 1,           # Self-play processes per iteration (1 = play in the coach's own process).
+    'worker_threads': 1,        # Torch threads used by each self-play process.
+    'seed': 0,                  # Base seed of the self-play processes.
+    'inference_server': False,  # Evaluate the self-play processes' positions in one batching server process.
+    'inference_max_batch_size': 64,  # Positions after which the server evaluates a batch right away.
+    'inference_max_wait_us': 500,    # Longest a request waits for others to join its batch.
     'temp_threshold': 15,        #
     'update_threshold': 0.55,     # During arena playoff, new neural net will be accepted if threshold or more of games are won.
     'max_len_of_queue': 200000,    # Number of game examples to train the neural networks.
+    'replay_pi_dtype': 'float32',  # Storage of the replay buffer's policies ('float16' halves it).
+    'memmap_examples': False,      # Train from the memory-mapped example shards instead of an in-memory replay buffer.
+    'augment_symmetries': False,   # Store canonical examples only and apply a random symmetry to each sampled one.
     'num_mcts_sims': 50,          # Number of games moves for MCTS to simulate.
+    'mcts_batch_size': 1,         # Leaves ArrayMCTS gathers with virtual loss per batched network call (1 = sequential search).
+    'virtual_loss': 1,            # Visits counted as losses on each edge of a pending path while its leaf is evaluated.
     'arena_compare': 40,         # Number of games to play during arena play to determine if new net will be accepted.
+    'arena_workers': 1,          # Processes the arena games are spread over (1 = play them in the coach's process).
+    'arena_sprt': False,         # Stop the arena early once a sequential probability ratio test decides,
+    'sprt_p0': 0.5,              #   testing H0: the new net wins sprt_p0 of the decisive games
+    'sprt_p1': 0.6,              #   against H1: it wins sprt_p1 of them,
+    'sprt_alpha': 0.05,          #   with this chance of accepting a net that is not better
+    'sprt_beta': 0.05,           #   and this chance of rejecting a net that is. Undecided after arena_compare games: update_threshold.
     'cpuct': 1,
+    'mcts_tree': 'array',        # Search tree storage: 'array' (ArrayMCTS node pool), 'compiled' (CompiledMCTS) or 'dict' (MCTS).
+    'mcts_pool_size': 4096,      # Initial number of nodes preallocated by ArrayMCTS, doubled when full.
+    'reuse_tree': True,          # ArrayMCTS keeps the subtree of each new root and frees the rest of the tree.
+    'eval_cache_size': 200000,   # Network evaluations cached across the self-play episodes of an iteration (0 = off).
+    'metrics_file': './checkpoints/connect4/metrics.jsonl',  # Per-iteration phase times and search stats (.jsonl or .csv, None = off).
+    'profile_self_play': False,  # Run each iteration's self-play under cProfile, saved next to the checkpoints.
 
     'checkpoint': './checkpoints/connect4/',
     'load_model': True,
@@ -1,10 +1,81 @@
 import numpy as np
 import math
-from numba import njit, float64, int8
+import time
+from numba import njit
 
 EPS = 1e-8
 NAN = np.array([np.nan])
 
+
+@njit(cache=True)
+def puct_select(Nsa, Wsa, Ps, valid, Ns, cpuct):
+    """
+    Returns the valid action of a node with the highest PUCT score, the first
+    one on ties, from the node's rows of visit counts Nsa, summed values Wsa,
+    priors Ps and valid mask, and its visit count Ns.
+    """
+    sqrt_ns = math.sqrt(Ns)
+    sqrt_ns_eps = math.sqrt(Ns + EPS)
+    best_act = -1
+    cur_best = -np.inf
+    for a in range(len(Nsa)):
+        if not valid[a]:
+            continue
+        n = Nsa[a]
+        if n > 0:
+            u = Wsa[a] / n + cpuct * Ps[a] * sqrt_ns / (1 + n)
+        else:
+            u = cpuct * Ps[a] * sqrt_ns_eps  # Q = 0 ?
+        if u > cur_best:
+            cur_best = u
+            best_act = a
+    return best_act
+
+
+@njit(cache=True)
+def backup(Nsa, Wsa, Ns, path, v, virtual_loss):
+    """
+    Backs the value v of the last edge of path (rows of node, action from the
+    root down, v seen from the player choosing that edge) up the path, taking
+    back a virtual loss of virtual_loss visits from every edge.
+
+    Returns:
+        the value seen from the player choosing the first edge, negated as
+        search returns it
+    """
+    for i in range(len(path) - 1, -1, -1):
+        node, a = path[i, 0], path[i, 1]
+        Wsa[node, a] += v + virtual_loss
+        Nsa[node, a] += 1 - virtual_loss
+        Ns[node] += 1 - virtual_loss
+        v = -v
+    return v
+
+
+class SearchStats():
+    """
+    Work done by a search tree: simulations run, nodes created, network calls
+    (a batched call counts once), edges descended by all simulations and
+    seconds spent in run_simulations.
+    """
+    FIELDS = ('simulations', 'nodes', 'nnet_calls', 'depth', 'seconds')
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def add(self, other):
+        """
+        other: SearchStats or a dict of its fields
+        """
+        other = other if isinstance(other, dict) else other.as_dict()
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + other[field])
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
 class MCTS():
     def __init__(self, game, nnet, args):
         self.game = game
@@ -17,13 +88,21 @@ class MCTS():
 
         self.s_outcomes = dict()  # stores game.get_game_outcome for state s
         self.s_valid_actions = dict()  # stores game.get_valid_actions for state s
+        self.stats = SearchStats()
 
     def get_action_prob(self, canonicalBoard, temp=1):
-        for _ in range(self.args['num_mcts_sims']):
-            self.search(canonicalBoard)
-
-        s = self.game.state_to_string(canonicalBoard)
-        counts = [self.Nsa[(s, a)] if (s, a) in self.Nsa else 0 for a in range(self.game.get_action_size())]
+        """
+        Searches canonicalBoard for args['num_mcts_sims'] simulations, or with
+        search_anytime when args['move_time'] or args['move_nodes'] is set (its
+        statistics are kept in self.last_search), and returns the visit
+        distribution of the actions.
+        """
+        if self.args.get('move_time') or self.args.get('move_nodes'):
+            counts, self.last_search = self.search_anytime(canonicalBoard, self.args.get('move_time'),
+                                                           self.args.get('move_nodes'))
+        else:
+            self.run_simulations(canonicalBoard, self.args['num_mcts_sims'])
+            counts = self.get_counts(canonicalBoard)
 
         if temp == 0:
             bestAs = np.array(np.argwhere(counts == np.max(counts))).flatten()
@@ -36,12 +115,95 @@ class MCTS():
         counts_sum = float(sum(counts))
         probs = [x / counts_sum for x in counts]
         return probs
-    
-    def search(self, cannonical_state):
-        s = self.game.state_to_string(cannonical_state)
+
+    def search_anytime(self, canonicalBoard, seconds=None, max_nodes=None):
+        """
+        Searches canonicalBoard until seconds have passed or max_nodes nodes
+        have been added to the tree, whichever comes first, checking after
+        every args['mcts_batch_size'] simulations (at least 8). Unless
+        args['anytime_early_stop'] is False, it also stops once the most
+        visited action leads the second by more visits than the rest of the
+        budget is expected to add at the current rate, and once simulations
+        only reach terminal states. A terminal canonicalBoard is not searched.
+
+        Returns:
+            the visit counts at canonicalBoard and {'simulations', 'seconds',
+            'nodes', 'stop'}, stop being 'time', 'nodes', 'decided' or 'exhausted'
+        """
+        if seconds is None and max_nodes is None:
+            raise ValueError('search_anytime needs a time or a node budget')
+        start = time.time()
+        if self.game.get_game_outcome(canonicalBoard, 1) != 0:
+            return [0] * self.game.get_action_size(), {'simulations': 0, 'seconds': time.time() - start,
+                                                       'nodes': 0, 'stop': 'exhausted'}
+        step = max(self.args.get('mcts_batch_size', 1), 8)
+        early_stop = self.args.get('anytime_early_stop', True)
+        first = self.stats.as_dict()
+        reroot = True
+        while True:
+            before = self.stats.as_dict()
+            self.run_simulations(canonicalBoard, step, reroot=reroot)
+            reroot = False
+            elapsed = time.time() - start
+            sims = self.stats.simulations - first['simulations']
+            nodes = self.stats.nodes - first['nodes']
+            counts = self.get_counts(canonicalBoard)
+
+            stop = None
+            if seconds is not None and elapsed >= seconds:
+                stop = 'time'
+            elif max_nodes is not None and nodes >= max_nodes:
+                stop = 'nodes'
+            elif sum(counts) == 0:
+                # only the root has been evaluated yet
+                continue
+            elif early_stop:
+                if self.stats.nodes == before['nodes'] and self.stats.nnet_calls == before['nnet_calls']:
+                    stop = 'exhausted'
+                else:
+                    remaining = float('inf')
+                    if seconds is not None:
+                        remaining = sims / max(elapsed, 1e-9) * (seconds - elapsed)
+                    if max_nodes is not None and nodes:
+                        remaining = min(remaining, sims / nodes * (max_nodes - nodes))
+                    second, best = sorted(counts)[-2:]
+                    if best - second > remaining:
+                        stop = 'decided'
+            if stop is not None:
+                return counts, {'simulations': sims, 'seconds': elapsed, 'nodes': nodes, 'stop': stop}
+
+    def run_simulations(self, canonicalBoard, num_sims, reroot=True):
+        """
+        reroot: whether trees that support it may free the nodes outside the
+                subtree of canonicalBoard (args['reuse_tree']), False when
+                continuing a search of the same position
+        """
+        start = time.time()
+        key = self.game.get_hash(canonicalBoard)
+        for _ in range(num_sims):
+            self.search(canonicalBoard, key=key)
+        self.stats.simulations += num_sims
+        self.stats.seconds += time.time() - start
+
+    def get_counts(self, canonicalBoard):
+        """Returns the visit count of every action at canonicalBoard."""
+        s = self.game.get_hash(canonicalBoard)
+        return [self.Nsa[(s, a)] if (s, a) in self.Nsa else 0 for a in range(self.game.get_action_size())]
+
+    def search(self, cannonical_state, outcome=None, key=None):
+        """
+        outcome: game.get_game_outcome(cannonical_state, 1) when the caller
+                 already knows it from game.step, None to compute it here.
+        key: game.get_hash(cannonical_state) when the caller already knows it,
+             None to compute it here.
+        """
+        s = key if key is not None else self.game.get_hash(cannonical_state)
 
         if s not in self.s_outcomes:
-            self.s_outcomes[s] = self.game.get_game_outcome(cannonical_state, 1)
+            self.stats.nodes += 1
+            if outcome is None:
+                outcome = self.game.get_game_outcome(cannonical_state, 1)
+            self.s_outcomes[s] = outcome
 
         # terminal node    
         if self.s_outcomes[s] != 0:
@@ -50,6 +212,7 @@ class MCTS():
         if s not in self.Ps:
             # leaf node
             self.Ps[s], v = self.nnet.predict(cannonical_state)
+            self.stats.nnet_calls += 1
             valid_actions = self.game.get_valid_actions(cannonical_state)
             self.Ps[s] = self.Ps[s] * valid_actions
 
@@ -83,10 +246,11 @@ class MCTS():
 
         # print(best_act)
         a = best_act
-        next_state, next_player = self.game.get_next_state(cannonical_state, a, 1)
+        self.stats.depth += 1
+        next_state, next_player, outcome = self.game.step(cannonical_state, a, 1)
         next_state = self.game.get_cannonical_state(next_state, next_player)
 
-        v = self.search(next_state)
+        v = self.search(next_state, outcome, self.game.get_next_hash(s, cannonical_state, a))
 
         if (s, a) in self.Qsa:
             self.Qsa[(s, a)] = (self.Nsa[(s, a)] * self.Qsa[(s, a)] + v) / (self.Nsa[(s, a)] + 1)
@@ -99,3 +263,254 @@ class MCTS():
 
         self.Ns[s] += 1
         return -v
+
+
+class ArrayMCTS(MCTS):
+    """
+    Drop-in replacement for MCTS that keeps the tree in a pool of preallocated
+    numpy arrays instead of dicts keyed by (state, action).
+
+    Every node owns one row of the [num_nodes, action_size] blocks below, edges
+    are followed through integer child links, and the game's Zobrist key is
+    only needed when a new node is added (to find transpositions through
+    node_ids).
+    The pool doubles in size whenever it runs out of rows.
+    """
+
+    def __init__(self, game, nnet, args):
+        self.game = game
+        self.nnet = nnet
+        self.args = args
+        self.action_size = self.game.get_action_size()
+
+        capacity = self.args.get('mcts_pool_size', 1024)
+        self.Nsa = np.zeros((capacity, self.action_size), dtype=np.int32)  # visit counts of edge s,a
+        self.Wsa = np.zeros((capacity, self.action_size), dtype=np.float64)  # summed values of edge s,a (Q = W / N)
+        self.Ps = np.zeros((capacity, self.action_size), dtype=np.float64)  # initial policy (returned by neural net)
+        self.valid = np.zeros((capacity, self.action_size), dtype=np.bool_)  # game.get_valid_actions for node
+        self.children = np.full((capacity, self.action_size), -1, dtype=np.int32)  # node id reached by s,a, -1 if unknown
+        self.Ns = np.zeros(capacity, dtype=np.int32)  # #times node was visited
+        self.outcomes = np.zeros(capacity, dtype=np.float64)  # game.get_game_outcome for node
+        self.expanded = np.zeros(capacity, dtype=np.bool_)  # whether the network evaluated the node
+
+        self.states = []  # canonical state of every node
+        self.keys = []  # game.get_hash of every node
+        self.node_ids = dict()  # game.get_hash -> node id
+        self.num_nodes = 0
+        self.stats = SearchStats()
+
+    # per node arrays of the pool and the value of an unused row
+    POOL = (('Nsa', 0), ('Wsa', 0), ('Ps', 0), ('valid', 0), ('children', -1), ('Ns', 0), ('outcomes', 0),
+            ('expanded', 0))
+
+    def _grow(self):
+        capacity = 2 * len(self.Ns)
+        for name, fill in self.POOL:
+            old = getattr(self, name)
+            new = np.full((capacity,) + old.shape[1:], fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def reroot(self, cannonical_state):
+        """
+        Makes cannonical_state the root of the tree: the subtree below it keeps
+        its statistics, every other node is freed and the pool is compacted so
+        the freed rows get reused. The tree is emptied if cannonical_state has
+        not been reached yet.
+        """
+        root = self.node_ids.get(self.game.get_hash(cannonical_state))
+        keep = np.zeros(self.num_nodes, dtype=np.bool_)
+        if root is not None:
+            keep[root] = True
+            frontier = np.array([root])
+            while len(frontier):
+                children = np.unique(self.children[frontier])
+                children = children[children >= 0]
+                frontier = children[~keep[children]]
+                keep[frontier] = True
+
+        old_ids = np.flatnonzero(keep)
+        num_nodes = len(old_ids)
+        new_ids = np.full(self.num_nodes, -1, dtype=np.int32)
+        new_ids[old_ids] = np.arange(num_nodes)
+
+        for name, fill in self.POOL:
+            pool = getattr(self, name)
+            pool[:num_nodes] = pool[old_ids]
+            pool[num_nodes:self.num_nodes] = fill
+        children = self.children[:num_nodes]
+        children[children >= 0] = new_ids[children[children >= 0]]
+
+        self.states = [self.states[i] for i in old_ids]
+        self.keys = [self.keys[i] for i in old_ids]
+        self.node_ids = {s: node for node, s in enumerate(self.keys)}
+        self.num_nodes = num_nodes
+
+    def _add_node(self, cannonical_state, outcome=None, key=None):
+        s = key if key is not None else self.game.get_hash(cannonical_state)
+        node = self.node_ids.get(s)
+        if node is not None:
+            return node
+
+        if self.num_nodes == len(self.Ns):
+            self._grow()
+        node = self.num_nodes
+        self.num_nodes += 1
+        self.stats.nodes += 1
+
+        self.node_ids[s] = node
+        self.states.append(cannonical_state)
+        self.keys.append(s)
+        if outcome is None:
+            outcome = self.game.get_game_outcome(cannonical_state, 1)
+        self.outcomes[node] = outcome
+        return node
+
+    def _expand(self, node):
+        pi, v = self.nnet.predict(self.states[node])
+        self.stats.nnet_calls += 1
+        self._set_priors(node, pi)
+        return np.asarray(v).item()
+
+    def _predict_batch(self, states):
+        self.stats.nnet_calls += 1
+        if hasattr(self.nnet, 'predict_batch'):
+            return self.nnet.predict_batch(np.stack(states))
+        pis, vs = zip(*[self.nnet.predict(state) for state in states])
+        return np.stack(pis), np.array([np.asarray(v).item() for v in vs])
+
+    def _set_priors(self, node, pi):
+        valid_actions = self.game.get_valid_actions(self.states[node])
+        ps = pi * valid_actions
+
+        sum_of_Ps = np.sum(ps)
+        if sum_of_Ps > 0:
+            ps /= sum_of_Ps
+        else:
+            print("All valid moves were masked, settings all valid moves to be equally probably. Check if your NNet architecture is insufficient or you've get overfitting!")
+            ps = ps + valid_actions
+            ps /= np.sum(ps)
+
+        self.Ps[node] = ps
+        self.valid[node] = valid_actions
+        self.expanded[node] = True
+
+    def _select(self, node):
+        return puct_select(self.Nsa[node], self.Wsa[node], self.Ps[node], self.valid[node], self.Ns[node],
+                           self.args['cpuct'])
+
+    def _child(self, node, a):
+        child = self.children[node, a]
+        if child < 0:
+            state = self.states[node]
+            next_state, next_player, outcome = self.game.step(state, a, 1)
+            child = self._add_node(self.game.get_cannonical_state(next_state, next_player), outcome,
+                                   self.game.get_next_hash(self.keys[node], state, a))
+            self.children[node, a] = child
+        return child
+
+    def search(self, cannonical_state, outcome=None, key=None):
+        node = self._add_node(cannonical_state, outcome, key)
+        path = []
+
+        while True:
+            if self.outcomes[node] != 0:
+                # terminal node
+                v = -self.outcomes[node]
+                break
+            if not self.expanded[node]:
+                # leaf node
+                v = -self._expand(node)
+                break
+            a = self._select(node)
+            path.append((node, a))
+            node = self._child(node, a)
+
+        # v is the value of the last edge on the path, seen from the player choosing it
+        self.stats.depth += len(path)
+        return backup(self.Nsa, self.Wsa, self.Ns, np.array(path, dtype=np.int64).reshape(-1, 2), float(v), 0)
+
+    def search_batch(self, cannonical_state, k, key=None):
+        """
+        Runs k simulations at once: descends k paths from cannonical_state,
+        applying a virtual loss to every edge taken so later paths spread over
+        other branches, evaluates the distinct leaves they reach with a single
+        batched network call and then backs all paths up.
+
+        Returns:
+            the number of simulations performed (k, or 1 when only the root
+            had to be expanded)
+        """
+        root = self._add_node(cannonical_state, key=key)
+        if self.outcomes[root] == 0 and not self.expanded[root]:
+            # every path would stop at the root, so evaluate it on its own
+            self._expand(root)
+            return 1
+
+        virtual_loss = self.args.get('virtual_loss', 1)
+        paths = []  # (path, v) where v is None while the leaf awaits evaluation
+        leaves = dict()  # leaf node -> position in the batch
+
+        for _ in range(k):
+            node = root
+            path = []
+            while True:
+                if self.outcomes[node] != 0:
+                    v = -self.outcomes[node]
+                    break
+                if not self.expanded[node]:
+                    v = None
+                    leaves.setdefault(node, len(leaves))
+                    break
+                a = self._select(node)
+                path.append((node, a))
+                self.Nsa[node, a] += virtual_loss
+                self.Wsa[node, a] -= virtual_loss
+                self.Ns[node] += virtual_loss
+                node = self._child(node, a)
+            paths.append((path, node, v))
+            self.stats.depth += len(path)
+
+        if leaves:
+            pis, vs = self._predict_batch([self.states[leaf] for leaf in leaves])
+            for leaf, i in leaves.items():
+                self._set_priors(leaf, pis[i])
+
+        for path, leaf, v in paths:
+            if v is None:
+                v = -float(vs[leaves[leaf]])
+            backup(self.Nsa, self.Wsa, self.Ns, np.array(path, dtype=np.int64).reshape(-1, 2), float(v), virtual_loss)
+        return k
+
+    def run_simulations(self, canonicalBoard, num_sims, reroot=True):
+        if reroot and self.args.get('reuse_tree', False):
+            self.reroot(canonicalBoard)
+        k = self.args.get('mcts_batch_size', 1)
+        if k <= 1:
+            return super().run_simulations(canonicalBoard, num_sims)
+        start = time.time()
+        key = self.game.get_hash(canonicalBoard)
+        done = 0
+        while done < num_sims:
+            done += self.search_batch(canonicalBoard, min(k, num_sims - done), key)
+        self.stats.simulations += done
+        self.stats.seconds += time.time() - start
+
+    def get_counts(self, canonicalBoard):
+        node = self.node_ids.get(self.game.get_hash(canonicalBoard))
+        if node is None:
+            return [0] * self.action_size
+        return self.Nsa[node].tolist()
+
+
+def make_mcts(game, nnet, args):
+    """
+    Builds the search tree selected by args['mcts_tree']: 'dict' for MCTS,
+    'array' for ArrayMCTS, 'compiled' for CompiledMCTS.
+    """
+    if args.get('mcts_tree', 'dict') == 'compiled':
+        from compiled_mcts import CompiledMCTS  # compiled_mcts imports this module
+        return CompiledMCTS(game, nnet, args)
+    if args.get('mcts_tree', 'dict') == 'array':
+        return ArrayMCTS(game, nnet, args)
+    return MCTS(game, nnet, args)
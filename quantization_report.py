@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import torch
+
+from inference import benchmark, compare, freeze, quantize, random_positions
+from replay_buffer import ShardedExamples, ShardStore
+
+# from tictactoe.tictactoe import TicTacToe as Game
+# from tictactoe.tictactoe_network import NNetWrapper as nn_wrapper
+from connect4.connect4 import Connect4 as Game
+from connect4.connect4_network import NNetWrapper as nn_wrapper
+
+args = {
+    'checkpoint': ('./checkpoints/connect4', 'best.pth.tar'),
+    'num_positions': 4096,         # Replay positions the quantized model is compared on.
+    'batch_sizes': (1, 8, 64),     # Batch sizes of the latency benchmark.
+    'benchmark_seconds': 2,        # Time spent measuring each batch size per model.
+}
+
+
+def sample_positions(game, folder, num_positions):
+    """
+    Returns up to num_positions random boards of the replay window whose shard
+    manifest is in folder/examples, or positions of random games if there is none.
+    """
+    store = ShardStore(os.path.join(folder, 'examples'))
+    shards = store.load_manifest()
+    if not shards:
+        print('No replay shards found, using positions of random games')
+        return random_positions(game, num_positions)
+    examples = ShardedExamples(store, shards)
+    ids = np.random.default_rng(0).choice(len(examples), size=min(num_positions, len(examples)), replace=False)
+    boards, _, _ = examples.gather(np.sort(ids))
+    return boards
+
+
+def main():
+    game = Game
+    nnet = nn_wrapper(game)
+    nnet.load_checkpoint(*args['checkpoint'])
+    nnet.nnet.cpu()  # int8 kernels are CPU only
+
+    boards = sample_positions(game, args['checkpoint'][0], args['num_positions'])
+    frozen = freeze(nnet.nnet)
+    quantized = quantize(nnet.nnet)
+
+    x = torch.as_tensor(boards, dtype=torch.float32)
+    with torch.no_grad():
+        kl_mean, kl_max, mae, max_error = compare(*quantized(x), *frozen(x))
+    print(f'{len(boards)} positions: policy KL mean {kl_mean:.2e} max {kl_max:.2e}, '
+          f'value MAE {mae:.2e} max {max_error:.2e}')
+
+    fused = benchmark(frozen, boards, args['batch_sizes'], args['benchmark_seconds'])
+    int8 = benchmark(quantized, boards, args['batch_sizes'], args['benchmark_seconds'])
+    print('batch   float ms   int8 ms  speedup')
+    for batch_size in args['batch_sizes']:
+        print(f'{batch_size:5d}  {fused[batch_size]:8.3f}  {int8[batch_size]:8.3f}  {fused[batch_size] / int8[batch_size]:6.2f}x')
+
+
+if __name__ == "__main__":
+    main()
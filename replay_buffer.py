@@ -0,0 +1,256 @@
+import json
+import os
+from collections import deque
+
+import numpy as np
+
+
+def to_arrays(examples, board_size, action_size, pi_dtype=np.float32):
+    """
+    examples: a sequence of (board, pi, v), or a (boards, pis, vs) tuple of arrays
+
+    Returns:
+        boards, pis, vs as int8 [N, rows, cols], pi_dtype [N, action_size] and float32 [N] arrays
+    """
+    if isinstance(examples, tuple) and len(examples) == 3 and isinstance(examples[0], np.ndarray):
+        boards, pis, vs = examples
+    else:
+        boards = [e[0] for e in examples]
+        pis = [e[1] for e in examples]
+        vs = [e[2] for e in examples]
+    return (np.asarray(boards, dtype=np.int8).reshape((-1,) + tuple(board_size)),
+            np.asarray(pis, dtype=pi_dtype).reshape(-1, action_size),
+            np.asarray(vs, dtype=np.float32))
+
+
+class ReplayBuffer():
+    """
+    Training examples of the latest self-play iterations, stored in one ring
+    buffer of compact arrays instead of deques of (board, pi, v) tuples:
+    boards as int8 [N, rows, cols], policies as [N, action_size] (float32 by
+    default, float16 to halve them again) and values as float32 [N].
+
+    Examples are added one iteration at a time, and every iteration keeps its
+    (start, length) slice so the oldest one can be evicted in O(1) by moving
+    the tail of the ring. The arrays grow by doubling up to capacity examples;
+    past that, the oldest iterations are evicted to make room.
+
+    The buffer is a training set for NNetWrapper.train: len() is the number
+    of examples and gather(ids) returns the arrays of the given examples.
+    """
+
+    def __init__(self, board_size, action_size, capacity, pi_dtype=np.float32):
+        self.board_size = tuple(board_size)
+        self.action_size = action_size
+        self.capacity = capacity
+        self.pi_dtype = pi_dtype
+        self.iterations = deque()  # (start, length) of every iteration, oldest first
+        self.tail = 0  # position of the oldest example
+        self.count = 0  # number of stored examples
+        self._allocate(0)
+
+    def _allocate(self, size):
+        self.boards = np.zeros((size,) + self.board_size, dtype=np.int8)
+        self.pis = np.zeros((size, self.action_size), dtype=self.pi_dtype)
+        self.vs = np.zeros(size, dtype=np.float32)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def num_iterations(self):
+        return len(self.iterations)
+
+    @property
+    def nbytes(self):
+        return self.boards.nbytes + self.pis.nbytes + self.vs.nbytes
+
+    def _positions(self, ids):
+        return (self.tail + np.asarray(ids)) % len(self.vs)
+
+    def gather(self, ids):
+        """
+        ids: indices in [0, len(self)), 0 being the oldest example
+
+        Returns:
+            boards, pis, vs of the examples
+        """
+        positions = self._positions(ids)
+        return self.boards[positions], self.pis[positions], self.vs[positions]
+
+    def get_iteration(self, index):
+        """
+        Returns:
+            boards, pis, vs of the examples of the index-th stored iteration (-1 is the latest)
+        """
+        lengths = [length for _, length in self.iterations]
+        index %= len(lengths)
+        offset = sum(lengths[:index])
+        return self.gather(np.arange(offset, offset + lengths[index]))
+
+    def pop_oldest(self):
+        """
+        Evicts the oldest iteration.
+        """
+        _, length = self.iterations.popleft()
+        self.tail = (self.tail + length) % max(len(self.vs), 1)
+        self.count -= length
+
+    def add_iteration(self, examples):
+        """
+        examples: the iteration's examples, either a sequence of (board, pi, v)
+                  or a (boards, pis, vs) tuple of arrays
+        """
+        boards, pis, vs = to_arrays(examples, self.board_size, self.action_size, self.pi_dtype)
+        n = min(len(vs), self.capacity)
+        boards, pis, vs = boards[len(vs) - n:], pis[len(vs) - n:], vs[len(vs) - n:]
+        if n == 0:
+            # still an iteration, so iterations stay aligned with the shards written for them
+            self.iterations.append((self.tail, 0))
+            return
+
+        while self.count + n > self.capacity:
+            self.pop_oldest()
+        if self.count + n > len(self.vs):
+            self._grow(min(max(2 * len(self.vs), self.count + n), self.capacity))
+
+        start = (self.tail + self.count) % len(self.vs)
+        positions = (start + np.arange(n)) % len(self.vs)
+        self.boards[positions] = boards
+        self.pis[positions] = pis
+        self.vs[positions] = vs
+        self.iterations.append((start, n))
+        self.count += n
+
+    def _grow(self, size):
+        """
+        Reallocates the arrays with room for size examples, moving the stored
+        ones to the front in order.
+        """
+        boards, pis, vs = self.gather(np.arange(self.count))
+        lengths = [length for _, length in self.iterations]
+        self._allocate(size)
+        self.boards[:self.count] = boards
+        self.pis[:self.count] = pis
+        self.vs[:self.count] = vs
+        self.tail = 0
+        self.iterations = deque()
+        start = 0
+        for length in lengths:
+            self.iterations.append((start, length))
+            start += length
+
+
+class ShardStore():
+    """
+    Training examples on disk, written once per iteration. Every iteration is
+    a shard of three .npy files (boards, pis, vs) in folder, and manifest.json
+    lists the shards of the current window, oldest first. The manifest is
+    replaced atomically, so after a crash it still names complete shards, and
+    shards it no longer lists are deleted by prune().
+    """
+    MANIFEST = 'manifest.json'
+    ARRAYS = ('boards', 'pis', 'vs')
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _path(self, name, array):
+        return os.path.join(self.folder, f'{name}.{array}.npy')
+
+    def load_manifest(self):
+        """
+        Returns:
+            shards: the shard entries of the manifest, or None if there is none
+        """
+        path = os.path.join(self.folder, self.MANIFEST)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return json.load(f)['shards']
+
+    def save_manifest(self, shards):
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, self.MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'shards': list(shards)}, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def write(self, iteration, boards, pis, vs, shards=()):
+        """
+        Writes a shard of the examples of an iteration.
+
+        shards: the entries of the current window, whose names the new shard must not reuse
+
+        Returns:
+            entry: the manifest entry of the shard
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        index = max([int(s['name'].split('_')[1]) for s in list(shards) + (self.load_manifest() or [])], default=-1) + 1
+        name = f'shard_{index:06d}'
+        for array, values in zip(self.ARRAYS, (boards, pis, vs)):
+            np.save(self._path(name, array), values)
+        return {'name': name, 'iteration': iteration, 'size': len(vs)}
+
+    def read(self, entry, mmap_mode=None):
+        """
+        Returns:
+            boards, pis, vs of the shard
+        """
+        return tuple(np.load(self._path(entry['name'], array), mmap_mode=mmap_mode) for array in self.ARRAYS)
+
+    def nbytes(self, shards):
+        """
+        Returns:
+            the size on disk of the files of shards
+        """
+        return sum(os.path.getsize(self._path(entry['name'], array)) for entry in shards for array in self.ARRAYS)
+
+    def prune(self, shards):
+        """
+        Deletes the shard files of the folder that are not in shards.
+        """
+        keep = {s['name'] for s in shards}
+        for filename in os.listdir(self.folder):
+            if filename.startswith('shard_') and filename.endswith('.npy') and filename.split('.')[0] not in keep:
+                os.remove(os.path.join(self.folder, filename))
+
+
+class ShardedExamples():
+    """
+    The examples of a window of shards, memory-mapped instead of loaded: the
+    same len()/gather(ids) training set as ReplayBuffer, but opening it reads
+    no examples and each gather only pages in the rows it asks for, so the
+    window may be larger than memory.
+    """
+
+    def __init__(self, store, shards):
+        """
+        store: the ShardStore holding the shards
+        shards: manifest entries of the window, oldest first
+        """
+        self.arrays = [store.read(entry, mmap_mode='r') for entry in shards]
+        self.offsets = np.cumsum([0] + [len(vs) for _, _, vs in self.arrays])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def gather(self, ids):
+        """
+        ids: indices in [0, len(self)), numbered through the shards in order
+
+        Returns:
+            boards, pis, vs of the examples
+        """
+        ids = np.asarray(ids)
+        shard_ids = np.searchsorted(self.offsets, ids, side='right') - 1
+        boards, pis, vs = self.arrays[0]
+        boards = np.empty((len(ids),) + boards.shape[1:], dtype=boards.dtype)
+        pis = np.empty((len(ids),) + pis.shape[1:], dtype=pis.dtype)
+        vs = np.empty(len(ids), dtype=vs.dtype)
+        for shard_id in np.unique(shard_ids):
+            rows = shard_ids == shard_id
+            local = ids[rows] - self.offsets[shard_id]
+            shard_boards, shard_pis, shard_vs = self.arrays[shard_id]
+            boards[rows], pis[rows], vs[rows] = shard_boards[local], shard_pis[local], shard_vs[local]
+        return boards, pis, vs
@@ -2,6 +2,11 @@ import numpy as np
 
 N = 3
 
+# random key of every (cell, player 1 / player -1) pair; bit 0 is kept free
+# for the side to move, see TicTacToe.get_hash
+ZOBRIST = [[int(x) & ~1 for x in cell] for cell in
+           np.random.default_rng(N * N).integers(0, 2**63, size=(N * N, 2), dtype=np.uint64)]
+
 class TicTacToe:
     """
     A class representing the game of Tic-Tac-Toe.
@@ -30,6 +35,27 @@ class TicTacToe:
         new_state[row, col] = player
         return new_state, -player
 
+    @staticmethod
+    def step(state: np.ndarray, action: int, player: int) -> tuple[np.ndarray, int, int]:
+        """
+        get_next_state followed by get_game_outcome(next_state, next_player),
+        checking only the lines through the new mark. state must not be
+        terminal yet.
+        """
+        if action == N*N:
+            return state, -player, TicTacToe.get_game_outcome(state, -player)
+        row, col = action // N, action % N
+        new_state = state.copy()
+        new_state[row, col] = player
+
+        mask = new_state == player
+        if mask[row].all() or mask[:, col].all() or \
+                (row == col and np.diag(mask).all()) or (row + col == N - 1 and np.diag(mask[:, ::-1]).all()):
+            return new_state, -player, -1
+        if new_state.all():
+            return new_state, -player, 1e-4
+        return new_state, -player, 0
+
     @staticmethod
     def get_valid_actions(state: np.ndarray) -> np.ndarray:
         valid = (state.reshape(-1) == 0).astype(int)
@@ -86,5 +112,29 @@ class TicTacToe:
                 print("-" * (4 * size - 3))
 
 
+    @staticmethod
     def state_to_string(state: np.ndarray) -> str:
-        return state.tostring()
\ No newline at end of file
+        return state.tobytes()
+
+    @staticmethod
+    def get_hash(state: np.ndarray) -> int:
+        """
+        64-bit Zobrist key of a canonical state. Player 1 moves first, so the
+        number of marks tells whether the player to move (+1 in the canonical
+        state) is player 1 or -1; the key hashes the board in player 1/-1
+        terms and stores the side to move in bit 0.
+        """
+        side = int(np.count_nonzero(state) % 2)  # 0: player 1 to move, 1: player -1 to move
+        board = (state if side == 0 else -state).reshape(-1)
+        key = side
+        for cell in np.flatnonzero(board):
+            key ^= ZOBRIST[cell][int(board[cell] < 0)]
+        return key
+
+    @staticmethod
+    def get_next_hash(key: int, state: np.ndarray, action: int) -> int:
+        """
+        get_hash of the canonical state reached by playing action in the
+        canonical state, whose key is key, in O(1).
+        """
+        return key ^ ZOBRIST[action][key & 1] ^ 1
\ No newline at end of file
@@ -7,6 +7,9 @@ import time
 import os
 from tqdm.auto import tqdm
 
+from inference import freeze, quantize
+from training import MinibatchPipeline, as_training_set
+
 args = {
     'lr': 0.001,
     'dropout': 0.3,
@@ -15,6 +18,8 @@ args = {
     'cuda': torch.cuda.is_available(),
     'mps': torch.backends.mps.is_available(),
     'num_channels': 512,
+    'fused_inference': True,  # MCTS evaluates with a frozen TorchScript model with BatchNorm folded in
+    'quantized_inference': False,  # ... whose linear layers are dynamically quantized to int8 (CPU only)
 }
 
 class NNetWrapper:
@@ -22,6 +27,8 @@ class NNetWrapper:
         self.nnet = TicTacToeNN(game, args)
         self.board_x, self.board_y = game.get_board_size()
         self.action_size = game.get_action_size()
+        self.input_buffer = None  # reused float32 input tensor of predict_batch, grown on demand
+        self.inference_model = None  # frozen, BatchNorm-folded (and maybe quantized) copy of the current weights used by predict_batch
 
         if args['cuda']:
             self.nnet.cuda()
@@ -31,9 +38,13 @@ class NNetWrapper:
 
     def train(self, examples):
         """
-        examples: list of examples, each example is of form (board, pi, v)
+        examples: list of examples, each example is of form (board, pi, v),
+                  or a ReplayBuffer (anything with len() and gather(ids))
         """
+        self.inference_model = None  # the weights are about to change
         optimizer = optim.Adam(self.nnet.parameters())
+        device = 'cuda' if args['cuda'] else 'mps' if args['mps'] else None
+        examples = as_training_set(examples, (self.board_x, self.board_y), self.action_size)
 
         for epoch in range(args['epochs']):
             print('EPOCH ::: ' + str(epoch + 1))
@@ -42,22 +53,11 @@ class NNetWrapper:
             v_losses = AverageMeter()
 
             batch_count = int(len(examples) / args['batch_size'])
+            batches = MinibatchPipeline(examples, (self.board_x, self.board_y), self.action_size,
+                                        args['batch_size'], batch_count, device=device)
 
-            t = tqdm(range(batch_count), desc='Training Net')
-            for _ in t:
-                sample_ids = np.random.randint(len(examples), size=args['batch_size'])
-                boards, pis, vs = list(zip(*[examples[i] for i in sample_ids]))
-                boards = torch.FloatTensor(np.array(boards).astype(np.float64))
-                target_pis = torch.FloatTensor(np.array(pis))
-                target_vs = torch.FloatTensor(np.array(vs).astype(np.float64))
-
-                # predict
-                if args['cuda']:
-                    boards, target_pis, target_vs = boards.contiguous().cuda(), target_pis.contiguous().cuda(), target_vs.contiguous().cuda()
-
-                elif args['mps']:
-                    boards, target_pis, target_vs = boards.contiguous().to('mps'), target_pis.contiguous().to('mps'), target_vs.contiguous().to('mps')
-
+            t = tqdm(batches, desc='Training Net')
+            for boards, target_pis, target_vs in t:
                 # compute output
                 out_pi, out_v = self.nnet(boards)
                 l_pi = self.loss_pi(target_pis, out_pi)
@@ -73,6 +73,7 @@ class NNetWrapper:
                 optimizer.zero_grad()
                 total_loss.backward()
                 optimizer.step()
+            print(batches.stats())
 
     def predict(self, board):
         """
@@ -81,17 +82,44 @@ class NNetWrapper:
         # timing
         start = time.time()
 
-        # preparing input
-        board = torch.FloatTensor(board.astype(np.float64))
-        if args['cuda']: board = board.contiguous().cuda()
-        elif args['mps']: board = board.contiguous().to('mps')
-        board = board.view(1, self.board_x, self.board_y)
-        self.nnet.eval()
-        with torch.no_grad():
-            pi, v = self.nnet(board)
+        pi, v = self.predict_batch(np.asarray(board)[np.newaxis])
 
         # print('PREDICTION TIME TAKEN : {0:03f}'.format(time.time()-start))
-        return torch.exp(pi).data.cpu().numpy()[0], v.data.cpu().numpy()[0]
+        return pi[0], v[:1]
+
+    def predict_batch(self, boards):
+        """
+        boards: np array of shape [N, board_x, board_y]
+
+        Returns:
+            pis: [N, action_size] np array of policies
+            vs: [N] np array of values
+        """
+        n = len(boards)
+        if self.input_buffer is None or self.input_buffer.size(0) < n:
+            self.input_buffer = torch.empty((n, self.board_x, self.board_y), dtype=torch.float32,
+                                            pin_memory=args['cuda'])
+
+        # numpy casts straight into the float32 buffer, whatever the boards' dtype and strides
+        self.input_buffer.numpy()[:n] = boards
+        boards = self.input_buffer[:n]
+        if args['fused_inference'] and args['quantized_inference']:
+            pass  # the int8 model runs on the CPU
+        elif args['cuda']: boards = boards.cuda(non_blocking=True)
+        elif args['mps']: boards = boards.to('mps')
+
+        if args['fused_inference']:
+            if self.inference_model is None:
+                self.inference_model = quantize(self.nnet) if args['quantized_inference'] else freeze(self.nnet)
+            model = self.inference_model
+        else:
+            if self.nnet.training:
+                self.nnet.eval()
+            model = self.nnet
+        with torch.no_grad():
+            pi, v = model(boards)
+
+        return torch.exp(pi).cpu().numpy(), v.view(-1).cpu().numpy()
 
     def loss_pi(self, targets, outputs):
         return -torch.sum(targets * outputs) / targets.size()[0]
@@ -118,6 +146,22 @@ class NNetWrapper:
         map_location = None if args['cuda'] else 'cpu'
         checkpoint = torch.load(filepath, map_location=map_location, weights_only=True)
         self.nnet.load_state_dict(checkpoint['state_dict'])
+        self.inference_model = None
+
+    def load_inference_model(self, filename):
+        """
+        Evaluates positions with a frozen model saved by inference.export
+        until the weights change again. With quantized_inference the file must
+        hold an int8 model (inference.export with quantized), kept on the CPU.
+        """
+        device = 'cpu' if args['quantized_inference'] else next(self.nnet.parameters()).device
+        self.inference_model = torch.jit.load(filename, map_location=device)
+
+    def __getstate__(self):
+        # TorchScript modules do not pickle, the frozen model is rebuilt on first use
+        state = self.__dict__.copy()
+        state['inference_model'] = None
+        return state
 
 
 class TicTacToeNN(nn.Module):
@@ -163,7 +207,7 @@ class TicTacToeNN(nn.Module):
         pi = self.fc3(s)  # batch_size x action_size
         v = self.fc4(s)  # batch_size x 1
 
-        return F.softmax(pi, dim=1), torch.tanh(v)
+        return F.log_softmax(pi, dim=1), torch.tanh(v)
     
 
 class AverageMeter(object):
@@ -0,0 +1,28 @@
+import numpy as np
+
+from tictactoe.tictactoe import TicTacToe, N
+from vector_env import VectorEnv
+
+# cell indices of every row, column and diagonal
+LINES = np.array([[r * N + c for c in range(N)] for r in range(N)] +
+                 [[r * N + c for r in range(N)] for c in range(N)] +
+                 [[i * N + i for i in range(N)], [i * N + N - 1 - i for i in range(N)]])
+
+
+class TicTacToeVector(VectorEnv):
+    """
+    Many games of Tic-Tac-Toe in lockstep, see VectorEnv.
+    """
+    game = TicTacToe
+
+    def _empty_actions(self):
+        return self.states.reshape(self.num_games, -1) == 0
+
+    def _place(self, games, actions, players):
+        self.states[games, actions // N, actions % N] = players
+
+    def _is_win(self, discs):
+        return discs.reshape(len(discs), N * N)[:, LINES].all(2).any(1)
+
+    def _is_full(self, states):
+        return (states != 0).all((1, 2))
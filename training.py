@@ -0,0 +1,158 @@
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+from replay_buffer import ReplayBuffer
+
+
+def as_training_set(examples, board_size, action_size):
+    """
+    examples: a list of (board, pi, v), or anything with len() and gather(ids)
+              such as a ReplayBuffer or ShardedExamples
+
+    Returns:
+        the examples as a training set with len() and gather(ids)
+    """
+    if hasattr(examples, 'gather'):
+        return examples
+    buffer = ReplayBuffer(board_size, action_size, max(len(examples), 1))
+    buffer.add_iteration(examples)
+    return buffer
+
+
+class MinibatchPipeline():
+    """
+    The random minibatches of one training epoch, prepared on a background
+    thread while the previous batch trains.
+
+    Every batch is a single gather of batch_size random ids from the training
+    set, cast into one of num_slots sets of preallocated float32 tensors
+    (pinned when training on CUDA). A slot is handed back to the thread once
+    the training loop asks for the next batch, so at most num_slots - 1
+    batches are prepared ahead.
+    """
+
+    def __init__(self, examples, board_size, action_size, batch_size, batch_count, device=None, num_slots=3):
+        """
+        Input:
+            examples: training set, see as_training_set
+            batch_size, batch_count: size and number of the minibatches
+            device: 'cuda', 'mps' or None for the CPU
+        """
+        self.examples = as_training_set(examples, board_size, action_size)
+        self.batch_size = batch_size
+        self.batch_count = batch_count
+        self.device = device
+        pin = device == 'cuda'
+        self.slots = [(torch.empty((batch_size,) + tuple(board_size), pin_memory=pin),
+                       torch.empty((batch_size, action_size), pin_memory=pin),
+                       torch.empty(batch_size, pin_memory=pin)) for _ in range(num_slots)]
+        self.prepare_time = 0.  # seconds the thread spent gathering and casting batches
+        self.wait_time = 0.  # seconds the training loop waited for a batch
+        self.start_time = None
+        self.end_time = None
+
+    def __len__(self):
+        return self.batch_count
+
+    def _produce(self, free, ready, stop):
+        try:
+            for _ in range(self.batch_count):
+                slot = free.get()
+                if stop.is_set():
+                    return
+                start = time.time()
+                ids = np.random.randint(len(self.examples), size=self.batch_size)
+                boards, pis, vs = self.examples.gather(ids)
+                tensors = self.slots[slot]
+                # numpy casts straight into the float32 tensors
+                tensors[0].numpy()[:] = boards
+                tensors[1].numpy()[:] = pis
+                tensors[2].numpy()[:] = vs
+                self.prepare_time += time.time() - start
+                ready.put(slot)
+        except Exception as e:
+            ready.put(e)
+
+    def __iter__(self):
+        """
+        Yields:
+            boards, target_pis, target_vs tensors on the device, valid until the next batch is requested
+        """
+        free, ready, stop = queue.Queue(), queue.Queue(), threading.Event()
+        for slot in range(len(self.slots)):
+            free.put(slot)
+        thread = threading.Thread(target=self._produce, args=(free, ready, stop), daemon=True)
+        self.start_time = time.time()
+        thread.start()
+        try:
+            for _ in range(self.batch_count):
+                start = time.time()
+                slot = ready.get()
+                self.wait_time += time.time() - start
+                if isinstance(slot, Exception):
+                    raise slot
+                tensors = self.slots[slot]
+                if self.device is not None:
+                    tensors = tuple(t.to(self.device, non_blocking=True) for t in tensors)
+                yield tensors
+                free.put(slot)
+        finally:
+            stop.set()
+            free.put(None)
+            thread.join()
+            self.end_time = time.time()
+
+    def stats(self):
+        samples = self.batch_size * self.batch_count
+        elapsed = max(self.end_time - self.start_time, 1e-9)
+        return (f'{samples} samples in {elapsed:.2f}s ({samples / elapsed:.0f} samples/s), '
+                f'data preparation {self.prepare_time:.2f}s ({samples / max(self.prepare_time, 1e-9):.0f} samples/s), '
+                f'waited {self.wait_time:.2f}s for data')
+
+
+def symmetry_permutations(game):
+    """
+    The symmetries of game.get_symmetries as index permutations, found by
+    applying them to a board of cell indices and a policy of action indices.
+
+    Returns:
+        cells: [num_symmetries, rows * cols] with board_sym.ravel() = board.ravel()[cells[k]]
+        actions: [num_symmetries, action_size] with pi_sym = pi[actions[k]]
+    """
+    rows, cols = game.get_board_size()
+    syms = game.get_symmetries(np.arange(rows * cols).reshape(rows, cols), np.arange(game.get_action_size()))
+    cells = np.array([np.asarray(b).ravel() for b, _ in syms], dtype=np.intp)
+    actions = np.array([np.asarray(p) for _, p in syms], dtype=np.intp)
+    return cells, actions
+
+
+class SymmetricExamples():
+    """
+    A training set of canonical examples seen under every symmetry of the
+    game, applied when a minibatch is gathered instead of being stored.
+    Example i under symmetry k has id k * len(examples) + i, so uniform
+    random ids draw uniform (example, symmetry) pairs: the same distribution
+    as storing every symmetric copy, from a fraction of the memory.
+    """
+
+    def __init__(self, examples, game):
+        """
+        examples: training set of canonical examples, with len() and gather(ids)
+        """
+        self.examples = examples
+        self.cells, self.actions = symmetry_permutations(game)
+
+    def __len__(self):
+        return len(self.examples) * len(self.cells)
+
+    def gather(self, ids):
+        symmetries, ids = np.divmod(np.asarray(ids), len(self.examples))
+        boards, pis, vs = self.examples.gather(ids)
+        flat = boards.reshape(len(boards), -1)
+        boards = np.take_along_axis(flat, self.cells[symmetries], axis=1).reshape(boards.shape)
+        pis = np.take_along_axis(pis, self.actions[symmetries], axis=1)
+        return boards, pis, vs
@@ -0,0 +1,82 @@
+import numpy as np
+
+
+class VectorEnv:
+    """
+    num_games games of one kind, held as a single [num_games, rows, cols] int8
+    array and advanced in lockstep with numpy operations (no per game Python
+    loop). Subclasses set game to the Game class whose rules they vectorize and
+    implement _place, _is_win and _is_full.
+
+    Finished games are frozen: step ignores their actions until reset.
+    """
+    game = None
+
+    def __init__(self, num_games):
+        rows, cols = self.game.get_board_size()
+        self.num_games = num_games
+        self.action_size = self.game.get_action_size()
+        self.states = np.zeros((num_games, rows, cols), dtype=np.int8)
+        self.players = np.ones(num_games, dtype=np.int8)  # player to move in every game
+        self.outcomes = np.zeros(num_games)  # game.get_game_outcome(state, player to move) of every game
+
+    def reset(self, games=None):
+        """
+        games: index or boolean mask of the games to restart, None for all of them
+        """
+        if games is None:
+            games = slice(None)
+        self.states[games] = 0
+        self.players[games] = 1
+        self.outcomes[games] = 0
+
+    @property
+    def done(self):
+        return self.outcomes != 0
+
+    def get_cannonical_states(self):
+        """
+        Returns:
+            [num_games, rows, cols] canonical states, ready for NNetWrapper.predict_batch
+        """
+        return self.states * self.players[:, np.newaxis, np.newaxis]
+
+    def get_valid_actions(self):
+        """
+        Returns:
+            [num_games, action_size] int mask, laid out as game.get_valid_actions
+        """
+        valid = np.zeros((self.num_games, self.action_size), dtype=int)
+        valid[:, :-1] = self._empty_actions()
+        valid[:, -1] = ~valid[:, :-1].any(1)
+        return valid
+
+    def step(self, actions):
+        """
+        Plays actions[i] (which must be valid) in every unfinished game i.
+
+        Returns:
+            outcomes: [num_games] game.get_game_outcome of every game for its
+                      player to move, 0 while the game is still running
+        """
+        games = np.flatnonzero(self.outcomes == 0)
+        players = self.players[games]
+        self._place(games, np.asarray(actions)[games], players)
+
+        states = self.states[games]
+        wins = self._is_win(states == players[:, np.newaxis, np.newaxis])
+        self.outcomes[games] = np.where(wins, -1, np.where(self._is_full(states), 1e-4, 0))
+        self.players[games] = -players
+        return self.outcomes.copy()
+
+    def _empty_actions(self):
+        raise NotImplementedError
+
+    def _place(self, games, actions, players):
+        raise NotImplementedError
+
+    def _is_win(self, discs):
+        raise NotImplementedError
+
+    def _is_full(self, states):
+        raise NotImplementedError
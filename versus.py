@@ -1,21 +1,27 @@
 import numpy as np
-from mcts import MCTS
+from mcts import make_mcts
 # from tictactoe.tictactoe import TicTacToe as Game
 # from tictactoe.tictactoe_network import NNetWrapper as nn
 from connect4.connect4 import Connect4 as Game
+# from connect4.connect4_bitboard import Connect4Bitboard as Game
 from connect4.connect4_network import NNetWrapper as nn
 from main import args
 
 args = {
-    'num_mcts_sims': 200,          # Number of games moves for MCTS to simulate.
+    'num_mcts_sims': 200,          # Number of games moves for MCTS to simulate, when no move budget is set.
+    'move_time': 1.0,              # Seconds the bot searches per move (None for no time limit).
+    'move_nodes': None,            # Nodes the bot adds to its tree per move (None for no node limit).
+    'anytime_early_stop': True,    # Stop searching once the best move cannot be overtaken within the budget.
     'cpuct': 1,
+    'mcts_tree': 'array',
+    'reuse_tree': True,
 }
 
 def main():
     game = Game
     nnet = nn(game)
     nnet.load_checkpoint('./checkpoints/connect4', 'best.pth.tar')
-    mcts = MCTS(game, nnet, args)
+    mcts = make_mcts(game, nnet, args)
 
     # Play against bot
     state = game.get_initial_state()
@@ -46,6 +52,10 @@ def main():
                 print('No valid actions left!')
                 break
             print(f'Bot move: {action}')
+            if hasattr(mcts, 'last_search'):
+                search = mcts.last_search
+                print(f'Searched {search["simulations"]} simulations, {search["nodes"]} nodes in '
+                      f'{search["seconds"]:.2f}s (stopped: {search["stop"]})')
 
         state, curPlayer = game.get_next_state(state, action, curPlayer)
 